@@ -0,0 +1,176 @@
+"""Local stand-in for the Telegram Bot API, enough for bot.py to run against it.
+
+Point the bot at it with BOT_API_URL=http://127.0.0.1:<port>/bot. Updates are
+injected with push_message()/push_callback(); every outgoing bot call is
+recorded and delivered to per-chat listeners so a driver can time replies.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from miniserver import Response, serve
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+class FakeBotAPI:
+    def __init__(self, member_status="member"):
+        self.member_status = member_status
+        self.calls = Counter()
+        self.bytes_uploaded = 0
+        self.polling = asyncio.Event()
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._file_id = 0
+        self._callback_id = 0
+        self._callback_users = {}  # callback query id -> user id, to route answerCallbackQuery
+        self._new_update = asyncio.Condition()
+        self._listeners = {}
+
+    # --- Driver side ---
+    def listen(self, chat_id):
+        return self._listeners.setdefault(chat_id, asyncio.Queue())
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    async def _push(self, update):
+        async with self._new_update:
+            self._update_id += 1
+            update["update_id"] = self._update_id
+            self._updates.append(update)
+            self._new_update.notify_all()
+        return time.monotonic()
+
+    async def push_message(self, user_id, text):
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return await self._push({"message": message})
+
+    async def push_callback(self, user_id, message_id, data):
+        self._callback_id += 1
+        self._callback_users[str(self._callback_id)] = user_id
+        return await self._push({"callback_query": {
+            "id": str(self._callback_id), "from": self._user(user_id), "chat_instance": str(user_id),
+            "data": data, "message": {
+                "message_id": message_id, "date": int(time.time()), "text": "",
+                "chat": {"id": user_id, "type": "private"}, "from": BOT_USER,
+            },
+        }})
+
+    # --- Bot side ---
+    async def _params(self, request):
+        content_type = request.headers.get("content-type", "")
+        params = dict(request.query)
+        if content_type.startswith("application/json"):
+            params.update(json.loads(request.body or b"{}"))
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(request.body.decode()))
+        elif content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + request.body
+            )
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True) or b""
+                if part.get_filename():
+                    self.bytes_uploaded += len(payload)
+                    params[name] = f"<upload:{len(payload)}>"
+                else:
+                    params[name] = payload.decode()
+        return params
+
+    def _message(self, chat_id, message_id=None, **fields):
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": int(message_id), "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, "from": BOT_USER, **fields}
+
+    def _media(self, value, **fields):
+        if value.startswith("file://"):
+            # Local mode: the server reads the file itself, like telegram-bot-api --local
+            path = unquote(urlsplit(value).path)
+            self.bytes_uploaded += os.path.getsize(path)
+        if value.startswith(("file://", "attach://", "<upload:")):
+            self._file_id += 1
+            value = f"bench-file-{self._file_id}"
+        return {"file_id": value, "file_unique_id": value, **fields}
+
+    async def _get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        async with self._new_update:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(self._updates[:100])
+
+    async def call(self, method, params):
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, params.get("message_id"), text=params.get("text", ""))
+        elif method == "sendVideo":
+            result = self._message(chat_id, video=self._media(params["video"], width=1280, height=720, duration=60))
+        elif method == "sendAudio":
+            result = self._message(chat_id, audio=self._media(params["audio"], duration=60))
+        elif method == "sendMediaGroup":
+            media = json.loads(params["media"])
+            result = [self._message(chat_id, video=self._media(item["media"], width=1280, height=720, duration=60))
+                      for item in media]
+        elif method == "copyMessage":
+            self._message_id += 1
+            result = {"message_id": self._message_id}
+        elif method == "getChatMember":
+            result = {"status": self.member_status, "user": self._user(int(params["user_id"]))}
+        else:  # answerCallbackQuery, deleteWebhook, setWebhook, logOut, ...
+            result = True
+        if method == "answerCallbackQuery":
+            chat_id = self._callback_users.pop(params.get("callback_query_id"), None)
+        listener = self._listeners.get(int(chat_id)) if chat_id is not None else None
+        if listener is not None:
+            listener.put_nowait((time.monotonic(), method, params))
+        return result
+
+    async def handle(self, request):
+        # /bot<token>/<method>
+        method = request.path.rstrip("/").rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        params = await self._params(request)
+        result = await self.call(method, params)
+        return Response(200, json.dumps({"ok": True, "result": result}))
+
+    async def start(self, port=0):
+        self.server, self.port = await serve(self.handle, port=port)
+        return self.port
+
+
+async def main():
+    api = FakeBotAPI()
+    port = await api.start(8081)
+    print(f"Fake Bot API on http://127.0.0.1:{port}/bot")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
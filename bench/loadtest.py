@@ -0,0 +1,278 @@
+"""Offline load test for bot.py.
+
+Starts a fake Bot API server and a local media origin, launches bot.py
+against them, and simulates N users who each send /start, a video link, and
+then tap a quality button. Reports throughput, p50/p99 latency per handler
+and the bot's peak memory and scratch disk usage.
+
+    python bench/loadtest.py --users 50 --videos 10
+    python bench/loadtest.py --users 200 --videos 5 --duration 300 --json result.json
+
+Bot settings (DOWNLOAD_WORKERS, MAX_ACTIVE_DOWNLOADS, ...) are taken from the
+environment, so the same run can be repeated before and after a change.
+With --workers N the bot runs as a frontend over a SQLite job queue and N
+`bot.py worker` processes do the downloads.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from media_origin import MediaOrigin  # noqa: E402
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+FAILURE_PREFIXES = ("❌", "🚦", "⏳ You already")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def next_event(queue, deadline):
+    return await asyncio.wait_for(queue.get(), max(0.001, deadline - time.monotonic()))
+
+
+async def wait_for_reply(queue, deadline, accept):
+    # Skip events until accept() returns True (done, ok) or False (done, failed)
+    while True:
+        event = await next_event(queue, deadline)
+        verdict = accept(*event)
+        if verdict is not None:
+            return event[0], verdict, event
+
+
+def link_reply(at, method, params):
+    text = params.get("text", "")
+    if method == "editMessageText" and "inline_keyboard" in params.get("reply_markup", ""):
+        return True
+    if method in ("sendMessage", "editMessageText") and text.startswith(FAILURE_PREFIXES):
+        return False
+    return None
+
+
+def download_reply(at, method, params):
+    text = params.get("text", "")
+    if method == "sendMessage" and "sent successfully" in text:
+        return True
+    if method == "sendMessage" and text.startswith(FAILURE_PREFIXES):
+        return False
+    if method == "answerCallbackQuery" and params.get("show_alert") in ("true", True):
+        return False
+    return None
+
+
+async def user_flow(api, user_id, url, choose, timeout, results):
+    queue = api.listen(user_id)
+    deadline = time.monotonic() + timeout
+    try:
+        sent = await api.push_message(user_id, "/start")
+        at, _, _ = await wait_for_reply(queue, deadline, lambda at, m, p: True if m == "sendMessage" else None)
+        results["start"].append((at - sent, True))
+
+        sent = await api.push_message(user_id, url)
+        at, ok, (_, _, params) = await wait_for_reply(queue, deadline, link_reply)
+        results["link"].append((at - sent, ok))
+        if not ok:
+            return
+        buttons = [
+            button["callback_data"]
+            for row in json.loads(params["reply_markup"])["inline_keyboard"]
+            for button in row
+            if button.get("callback_data", "").startswith("dl_") and not button["callback_data"].endswith("_audio")
+        ]
+        data = choose(buttons)
+
+        sent = await api.push_callback(user_id, int(params["message_id"]), data)
+        at, ok, _ = await wait_for_reply(queue, deadline, download_reply)
+        results["download"].append((at - sent, ok))
+    except asyncio.TimeoutError:
+        results["timeouts"] += 1
+
+
+def process_tree_rss(pid):
+    # Resident memory of the bot plus its download worker processes (Linux /proc)
+    children = {pid}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) in children:
+                        children.add(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    total = 0
+    for child in children:
+        try:
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+async def sample(pids, scratch_dir, peaks, stop):
+    while not stop.is_set():
+        peaks["rss"] = max(peaks["rss"], sum(process_tree_rss(pid) for pid in pids))
+        peaks["disk"] = max(peaks["disk"], directory_size(scratch_dir))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="savvybench-")
+    scratch_dir = os.path.join(workdir, "scratch")
+    api = FakeBotAPI()
+    origin = MediaOrigin(duration=args.duration, heights=args.heights, rate=args.origin_rate)
+    api_port = await api.start()
+    origin_port = await origin.start()
+
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:BENCH",
+        BOT_API_URL=f"http://127.0.0.1:{api_port}/bot",
+        BOT_API_FILE_URL=f"http://127.0.0.1:{api_port}/file/bot",
+        BOT_API_LOCAL_MODE="1" if args.local_mode else "0",
+        DB_PATH=os.path.join(workdir, "bench.db"),
+        SCRATCH_DIR=scratch_dir,
+        METRICS_PORT="0",
+        EXTRA_SUPPORTED_HOSTS="127.0.0.1",
+    )
+    if args.workers:
+        env["JOB_QUEUE_URL"] = f"sqlite://{os.path.join(workdir, 'jobs.db')}"
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    bot = await asyncio.create_subprocess_exec(sys.executable, BOT_PATH, env=env, stdout=log, stderr=log)
+    workers = []
+    for n in range(args.workers):
+        # Workers share the scratch dir; each one works in its own subdirectory
+        workers.append(await asyncio.create_subprocess_exec(
+            sys.executable, BOT_PATH, "worker", env=env, stdout=log, stderr=log
+        ))
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(api.polling.wait(), 60)
+    except asyncio.TimeoutError:
+        for process in [bot] + workers:
+            process.kill()
+        sys.exit(f"bot.py did not start polling, see {log.name}")
+    startup = time.monotonic() - started
+
+    choose = {
+        "highest": lambda buttons: buttons[0],
+        "lowest": lambda buttons: buttons[-1],
+        "random": random.choice,
+    }[args.quality]
+    results = {"start": [], "link": [], "download": [], "timeouts": 0}
+    peaks = {"rss": 0, "disk": 0}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample([bot.pid] + [w.pid for w in workers], scratch_dir, peaks, stop))
+
+    async def delayed_flow(i):
+        await asyncio.sleep(args.ramp * i / max(1, args.users))
+        url = origin.url(origin_port, f"video{i % args.videos}")
+        await user_flow(api, 10_000 + i, url, choose, args.timeout, results)
+
+    began = time.monotonic()
+    await asyncio.gather(*(delayed_flow(i) for i in range(args.users)))
+    elapsed = time.monotonic() - began
+    stop.set()
+    await sampler
+
+    for process in [bot] + workers:
+        process.send_signal(signal.SIGINT)
+    for process in [bot] + workers:
+        try:
+            await asyncio.wait_for(process.wait(), 30)
+        except asyncio.TimeoutError:
+            process.kill()
+    log.close()
+    api.server.close()
+    origin.server.close()
+
+    completed = sum(1 for _, ok in results["download"] if ok)
+    report = {
+        "users": args.users,
+        "videos": args.videos,
+        "elapsed_s": round(elapsed, 2),
+        "bot_startup_s": round(startup, 2),
+        "downloads_ok": completed,
+        "throughput_downloads_per_s": round(completed / elapsed, 3) if elapsed else None,
+        "timeouts": results["timeouts"],
+        "handlers": {},
+        "peak_rss_mb": round(peaks["rss"] / 1024 ** 2, 1),
+        "peak_scratch_mb": round(peaks["disk"] / 1024 ** 2, 1),
+        "origin_mb": round(origin.bytes_served / 1024 ** 2, 1),
+        "uploaded_mb": round(api.bytes_uploaded / 1024 ** 2, 1),
+        "api_calls": dict(api.calls),
+    }
+    for name in ("start", "link", "download"):
+        latencies = [latency for latency, _ in results[name]]
+        report["handlers"][name] = {
+            "count": len(latencies),
+            "failed": sum(1 for _, ok in results[name] if not ok),
+            "p50_s": round(percentile(latencies, 0.5), 3) if latencies else None,
+            "p99_s": round(percentile(latencies, 0.99), 3) if latencies else None,
+        }
+
+    print(f"\nusers={args.users} videos={args.videos} elapsed={report['elapsed_s']}s "
+          f"startup={report['bot_startup_s']}s timeouts={report['timeouts']}")
+    print(f"{'handler':<10}{'count':>7}{'failed':>8}{'p50 s':>10}{'p99 s':>10}")
+    for name, stats in report["handlers"].items():
+        print(f"{name:<10}{stats['count']:>7}{stats['failed']:>8}{stats['p50_s'] or '-':>10}{stats['p99_s'] or '-':>10}")
+    print(f"throughput: {report['throughput_downloads_per_s']} downloads/s")
+    print(f"peak RSS (bot + workers): {report['peak_rss_mb']} MB, peak scratch: {report['peak_scratch_mb']} MB")
+    print(f"origin served: {report['origin_mb']} MB, uploaded: {report['uploaded_mb']} MB")
+    print(f"bot log: {log.name}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--videos", type=int, default=5, help="distinct videos shared by the users")
+    parser.add_argument("--duration", type=int, default=60, help="video length in seconds")
+    parser.add_argument("--heights", type=int, nargs="+", default=[360, 720])
+    parser.add_argument("--quality", choices=("highest", "lowest", "random"), default="random")
+    parser.add_argument("--ramp", type=float, default=0, help="seconds over which users arrive")
+    parser.add_argument("--origin-rate", type=int, default=0, help="bytes/s per origin response, 0 = unlimited")
+    parser.add_argument("--workers", type=int, default=0, help="run downloads in N separate worker processes")
+    parser.add_argument("--local-mode", action="store_true", help="upload by file path as with a local Bot API server")
+    parser.add_argument("--timeout", type=float, default=600, help="per-user timeout in seconds")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Local HTTP origin serving synthetic HLS videos that yt-dlp's generic extractor can fetch.
+
+Every video id serves the same renditions:
+
+    /v/<id>/master.m3u8               master playlist (RESOLUTION + CODECS per rendition)
+    /v/<id>/<height>.m3u8             VOD media playlist
+    /v/<id>/<height>/<n>.ts           segment of bitrate * SEGMENT_SECONDS / 8 bytes
+
+Segment payloads are filler bytes: the bot never decodes them, it only moves them.
+"""
+import asyncio
+
+from miniserver import Response, serve
+
+SEGMENT_SECONDS = 4
+RENDITIONS = {  # height -> (width, kbit/s, codecs)
+    360: (640, 800, "avc1.42e01e,mp4a.40.2"),
+    720: (1280, 2500, "avc1.4d401f,mp4a.40.2"),
+    1080: (1920, 5000, "avc1.640028,mp4a.40.2"),
+}
+
+
+class MediaOrigin:
+    def __init__(self, duration=60, heights=(360, 720), rate=0):
+        self.duration = duration
+        self.heights = [h for h in heights if h in RENDITIONS]
+        self.rate = rate  # bytes/second per response, 0 = unthrottled
+        self.bytes_served = 0
+        self._segments = {}
+
+    def url(self, port, video_id):
+        return f"http://127.0.0.1:{port}/v/{video_id}/master.m3u8"
+
+    def _segment(self, height):
+        if height not in self._segments:
+            size = RENDITIONS[height][1] * 1000 * SEGMENT_SECONDS // 8
+            self._segments[height] = bytes(size)
+        return self._segments[height]
+
+    def _master(self):
+        lines = ["#EXTM3U"]
+        for height in self.heights:
+            width, kbps, codecs = RENDITIONS[height]
+            lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={kbps * 1000},RESOLUTION={width}x{height},CODECS="{codecs}"')
+            lines.append(f"{height}.m3u8")
+        return "\n".join(lines) + "\n"
+
+    def _media(self, height):
+        lines = [
+            "#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}",
+            "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for n in range(max(1, self.duration // SEGMENT_SECONDS)):
+            lines += [f"#EXTINF:{SEGMENT_SECONDS}.0,", f"{height}/{n}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        parts = request.path.strip("/").split("/")
+        if len(parts) < 3 or parts[0] != "v":
+            return Response(404, "not found", "text/plain")
+        playlist = "application/vnd.apple.mpegurl"
+        if parts[2] == "master.m3u8":
+            return Response(200, self._master(), playlist)
+        if parts[2].endswith(".m3u8") and int(parts[2][:-5]) in self.heights:
+            return Response(200, self._media(int(parts[2][:-5])), playlist)
+        if len(parts) == 4 and parts[3].endswith(".ts") and int(parts[2]) in self.heights:
+            body = self._segment(int(parts[2]))
+            if self.rate:
+                await asyncio.sleep(len(body) / self.rate)
+            self.bytes_served += len(body)
+            return Response(200, body, "video/mp2t")
+        return Response(404, "not found", "text/plain")
+
+    async def start(self, port=0):
+        self.server, self.port = await serve(self.handle, port=port)
+        return self.port
+
+
+async def main():
+    origin = MediaOrigin()
+    port = await origin.start(8765)
+    print(f"Serving test media, e.g. {origin.url(port, 'demo')}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,37 @@
 import os
+import sys
+import time
+import asyncio
 import logging
+import fcntl
 import glob
+import math
+import shutil
+import re
+import json
+import secrets
+import sqlite3
+import heapq
+import itertools
+import multiprocessing
+import threading
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from urllib.parse import urlparse
 from uuid import uuid4
 from telegram import (
-    Update, KeyboardButton, ReplyKeyboardMarkup,
-    InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
+    Bot, Update, KeyboardButton, ReplyKeyboardMarkup,
+    InlineKeyboardButton, InlineKeyboardMarkup, ChatMember, InputMediaAudio, InputMediaVideo
 )
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler,
     ConversationHandler, filters, ContextTypes
 )
 from telegram.constants import ParseMode
-from yt_dlp import YoutubeDL
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +41,117 @@ BOT_TOKEN = os.getenv('BOT_TOKEN', '8413258612:AAHmrd9F_9YT6xBIaqlrn4ZN3-R5HhtcK
 ADMIN_ID = 5610858626
 MAX_FILESIZE = 1950 * 1024 * 1024  # 1.95GB safety limit
 
+# Update delivery: "polling" (default) or "webhook" with an embedded HTTP server.
+# Webhook mode needs the public HTTPS URL Telegram should post to, typically a
+# reverse proxy in front of WEBHOOK_LISTEN:WEBHOOK_PORT.
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Upload transport: a self-hosted telegram-bot-api server started with --local
+# reads uploads straight from disk (it must see the same filesystem) and
+# accepts files up to 2GB. The public API takes multipart uploads up to 50MB.
+BOT_API_URL = os.getenv('BOT_API_URL')  # e.g. http://127.0.0.1:8081/bot
+BOT_API_FILE_URL = os.getenv('BOT_API_FILE_URL')  # e.g. http://127.0.0.1:8081/file/bot
+LOCAL_BOT_API = bool(BOT_API_URL) and os.getenv('BOT_API_LOCAL_MODE', '1') == '1'
+PUBLIC_UPLOAD_LIMIT = 50 * 1024 * 1024
+UPLOAD_LIMIT = MAX_FILESIZE if LOCAL_BOT_API else PUBLIC_UPLOAD_LIMIT
+UPLOAD_TIMEOUT = float(os.getenv('UPLOAD_TIMEOUT', '600'))  # seconds
+# Files over UPLOAD_LIMIT are cut into at most this many parts (needs ffmpeg)
+SPLIT_MAX_PARTS = int(os.getenv('SPLIT_MAX_PARTS', '10'))
+
+# Hosts accepted in addition to the known platforms, e.g. a self-hosted site or the bench media origin
+EXTRA_SUPPORTED_HOSTS = [h.strip() for h in os.getenv('EXTRA_SUPPORTED_HOSTS', '').split(',') if h.strip()]
+
+# Scratch space for downloads and merges
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', '/tmp/savvybot')
+SCRATCH_QUOTA = int(float(os.getenv('SCRATCH_QUOTA_GB', '20')) * 1024 ** 3)  # per process: split it between workers on a host
+DB_PATH = os.getenv('DB_PATH', 'savvybot.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '5'))  # seconds between batched user writes
+
+# Broadcast: Telegram allows ~30 messages/second to different chats
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # messages/second
+BROADCAST_CHUNK = int(os.getenv('BROADCAST_CHUNK', '100'))  # sends in flight between checkpoints
+BROADCAST_RETRIES = 3
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between progress message edits
+
+# Worker pools: metadata extraction runs on threads, downloads/merges in processes
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '8'))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', '60'))  # seconds
+DOWNLOAD_TIMEOUT = float(os.getenv('DOWNLOAD_TIMEOUT', '1800'))  # seconds
+# Per network read in yt-dlp: wait_for cannot stop a pool thread, a stalled socket must time out by itself
+SOCKET_TIMEOUT = float(os.getenv('SOCKET_TIMEOUT', '20'))  # seconds
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
+
+# Prometheus-style metrics endpoint, local only by default; port 0 disables it
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+
+# Parallel fragment downloads for DASH/HLS, per extractor, e.g. "Youtube=8,TikTok=2"
+FRAGMENT_CONCURRENCY_DEFAULT = int(os.getenv('FRAGMENT_CONCURRENCY_DEFAULT', '4'))
+FRAGMENT_CONCURRENCY = {
+    name.strip(): int(value)
+    for name, value in (
+        item.split('=') for item in os.getenv('FRAGMENT_CONCURRENCY', 'Youtube=8').split(',') if item.strip()
+    )
+}
+
+# Per-platform extraction health, keyed by yt-dlp extractor, e.g. "Youtube=5,Instagram=0.5" (requests/second)
+PLATFORM_RATE_DEFAULT = float(os.getenv('PLATFORM_RATE_DEFAULT', '10'))
+PLATFORM_RATES = {
+    name.strip(): float(value)
+    for name, value in (
+        item.split('=') for item in os.getenv('PLATFORM_RATES', 'Instagram=1').split(',') if item.strip()
+    )
+}
+PLATFORM_BACKOFF_BASE = float(os.getenv('PLATFORM_BACKOFF_BASE', '2'))  # seconds, doubled per consecutive block
+PLATFORM_BACKOFF_MAX = float(os.getenv('PLATFORM_BACKOFF_MAX', '900'))  # seconds
+PLATFORM_MAX_WAIT = float(os.getenv('PLATFORM_MAX_WAIT', '15'))  # seconds a link may wait for its platform's rate
+PLATFORM_BREAKER_THRESHOLD = int(os.getenv('PLATFORM_BREAKER_THRESHOLD', '3'))  # consecutive blocks that open the circuit
+# Comma-separated pools; a blocked platform moves on to the next proxy/cookie file combination
+EXTRACT_PROXIES = [p.strip() for p in os.getenv('EXTRACT_PROXIES', '').split(',') if p.strip()]
+EXTRACT_COOKIE_FILES = [c.strip() for c in os.getenv('EXTRACT_COOKIE_FILES', '').split(',') if c.strip()]
+
+# Live progress: a chat's status message is edited at most every PROGRESS_INTERVAL
+# seconds, and all chats together stay within PROGRESS_EDIT_RATE edits/second
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '3'))  # seconds
+PROGRESS_EDIT_RATE = float(os.getenv('PROGRESS_EDIT_RATE', '10'))  # edits/second
+
+# Download scheduling: jobs beyond MAX_ACTIVE_DOWNLOADS wait in a bounded queue
+MAX_ACTIVE_DOWNLOADS = int(os.getenv('MAX_ACTIVE_DOWNLOADS', str(DOWNLOAD_WORKERS)))
+MAX_USER_DOWNLOADS = int(os.getenv('MAX_USER_DOWNLOADS', '2'))  # queued + running per user
+MAX_QUEUED_DOWNLOADS = int(os.getenv('MAX_QUEUED_DOWNLOADS', '50'))
+
+# Distributed downloads: with a queue URL (sqlite:///absolute/path.db or redis://host/db) the bot
+# only enqueues jobs and separate `python bot.py worker` processes run them
+JOB_QUEUE_URL = os.getenv('JOB_QUEUE_URL')
+JOB_MAX_OUTSTANDING = int(os.getenv('JOB_MAX_OUTSTANDING', '500'))  # queued + running jobs per frontend
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', str(DOWNLOAD_WORKERS)))  # jobs per worker process
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))  # seconds
+JOB_STALE_AFTER = float(os.getenv('JOB_STALE_AFTER', '120'))  # seconds without a heartbeat before a job is requeued
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '2'))
+
+# Metadata cache: TTL must stay well below the lifetime of signed format URLs (~6h on YouTube)
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', '2048'))
+METADATA_CACHE_TTL = float(os.getenv('METADATA_CACHE_TTL', '1800'))  # seconds
+
+# Batch mode: several links in one message, or a playlist link
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '25'))
+BATCH_EXTRACT_CONCURRENCY = int(os.getenv('BATCH_EXTRACT_CONCURRENCY', '4'))
+
+# Pending quality choices: one entry per analysed link, referenced by a token in the button data
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '50000'))
+SESSION_TTL = float(os.getenv('SESSION_TTL', '86400'))  # seconds
+
+# Positive channel-membership results are trusted for this long per (user, channel)
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '100000'))
+MEMBERSHIP_CACHE_TTL = float(os.getenv('MEMBERSHIP_CACHE_TTL', '600'))  # seconds
+
 # --- Storage ---
 initial_welcome_text = "👋 Welcome! Please join our channels to continue."
 welcome_text = """🎬 **Welcome to VideoSavvy Bot!**
@@ -39,11 +170,1545 @@ welcome_text = """🎬 **Welcome to VideoSavvy Bot!**
 
 welcome_media = None  # (type, file_id)
 required_channels = []
+channel_chat_ids = {}  # entry -> chat id for get_chat_member, resolved when the channel is added
 user_ids = set()
 
 # Conversation states
 (ADMIN_PANEL, EDIT_WELCOME, EDIT_INITIAL_WELCOME, ADD_CHANNEL, REMOVE_CHANNEL, BROADCAST, WELCOME_MEDIA) = range(7)
 
+# --- Metrics ---
+# In-process histograms and counters, exposed in Prometheus text format on a
+# local HTTP endpoint and summarised under "📊 Stats" in the admin panel.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000))
+
+class Metrics:
+    def __init__(self):
+        self._help = {}
+        self._buckets = {}
+        self._histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self._counters = {}  # name -> {labels: value}
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._help[name] = help_text
+        self._buckets[name] = buckets
+        self._histograms[name] = {}
+
+    def counter(self, name, help_text):
+        self._help[name] = help_text
+        self._counters[name] = {}
+
+    def observe(self, name, value, **labels):
+        buckets = self._buckets[name]
+        series = self._histograms[name].setdefault(tuple(sorted(labels.items())), [0] * (len(buckets) + 2))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def inc(self, name, amount=1, **labels):
+        series = self._counters[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+        lines = []
+        for name, series in self._histograms.items():
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} histogram"]
+            for labels, values in series.items():
+                for bound, count in zip(self._buckets[name], values):
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {values[-1]}")
+                lines.append(f"{name}_sum{fmt(labels)} {values[-2]}")
+                lines.append(f"{name}_count{fmt(labels)} {values[-1]}")
+        for name, series in self._counters.items():
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} counter"]
+            for labels, value in series.items():
+                lines.append(f"{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def quantile(self, name, q):
+        # Upper bound of the bucket holding the q-quantile, across all labels
+        buckets = self._buckets[name]
+        totals = [sum(values[i] for values in self._histograms[name].values()) for i in range(len(buckets) + 2)]
+        if not totals[-1]:
+            return None
+        for bound, count in zip(buckets, totals):
+            if count >= q * totals[-1]:
+                return bound
+        return float('inf')
+
+    def totals(self, name):
+        series = self._histograms[name].values()
+        return sum(v[-1] for v in series), sum(v[-2] for v in series)
+
+    def counts(self, name):
+        return dict(self._counters[name])
+
+    def sums(self, name):
+        return {labels: values[-2] for labels, values in self._histograms[name].items()}
+
+metrics = Metrics()
+metrics.histogram('savvy_extract_seconds', 'Metadata extraction latency')
+metrics.histogram('savvy_queue_wait_seconds', 'Time a download waited for a scheduler slot')
+metrics.histogram('savvy_download_seconds', 'yt-dlp download time, excluding the merge')
+metrics.histogram('savvy_merge_seconds', 'ffmpeg merge/remux time')
+metrics.histogram('savvy_upload_seconds', 'Telegram upload time')
+metrics.histogram('savvy_download_bytes', 'Bytes fetched per download', SIZE_BUCKETS)
+metrics.histogram('savvy_startup_seconds', 'Time since process start at which each startup stage finished')
+metrics.counter('savvy_cache_requests_total', 'Cache lookups by cache and result')
+metrics.counter('savvy_failures_total', 'Failed requests by stage and reason')
+metrics.counter('savvy_platform_errors_total', 'Extraction errors by platform and kind')
+
+async def serve_metrics(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # skip headers
+        if request.split()[1:2] == [b'/metrics']:
+            status, body = "200 OK", metrics.render()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+def metrics_summary():
+    lines = ["📊 Pipeline Stats", ""]
+    for label, name in (
+        ("🔍 Extract", 'savvy_extract_seconds'),
+        ("⏳ Queue wait", 'savvy_queue_wait_seconds'),
+        ("⬇️ Download", 'savvy_download_seconds'),
+        ("🎞 Merge", 'savvy_merge_seconds'),
+        ("📤 Upload", 'savvy_upload_seconds'),
+    ):
+        count, total = metrics.totals(name)
+        if count:
+            lines.append(
+                f"{label}: {count}× avg {total / count:.1f}s, "
+                f"p50 ≤ {metrics.quantile(name, 0.5)}s, p99 ≤ {metrics.quantile(name, 0.99)}s"
+            )
+        else:
+            lines.append(f"{label}: no data")
+    count, total = metrics.totals('savvy_download_bytes')
+    lines.append(f"📦 Downloaded: {count} files, {total / 1024 ** 3:.2f} GB")
+    stages = metrics.sums('savvy_startup_seconds')
+    if stages:
+        lines.append("🚀 Startup: " + ", ".join(
+            f"{dict(labels)['stage']} {value:.2f}s" for labels, value in sorted(stages.items(), key=lambda item: item[1])
+        ))
+    lines += platform_health.summary()
+    lines.append("")
+    for (cache, result), value in sorted(
+        ((dict(k)['cache'], dict(k)['result']), v) for k, v in metrics.counts('savvy_cache_requests_total').items()
+    ):
+        lines.append(f"💾 {cache} {result}: {value}")
+    failures = metrics.counts('savvy_failures_total')
+    if failures:
+        lines.append("")
+        for labels, value in sorted(failures.items(), key=lambda item: -item[1])[:10]:
+            labels = dict(labels)
+            lines.append(f"❌ {labels['stage']}/{labels['reason']}: {value}")
+    return "\n".join(lines)
+
+# --- Worker Pools ---
+# yt-dlp is fully blocking, so it never runs on the event loop. Handlers await
+# these wrappers and the bot keeps answering other updates meanwhile.
+# yt-dlp itself is imported lazily (see warm_up) so the bot polls right away.
+_extract_pool = None
+_download_pool = None
+_thread_state = threading.local()
+
+def get_extract_pool():
+    global _extract_pool
+    if _extract_pool is None:
+        _extract_pool = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
+    return _extract_pool
+
+def get_download_pool():
+    global _download_pool
+    if _download_pool is None:
+        # spawn: forking a process that already runs the event loop and httpx threads is unsafe
+        _download_pool = ProcessPoolExecutor(
+            max_workers=DOWNLOAD_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_import_yt_dlp
+        )
+    return _download_pool
+
+def shutdown_pools():
+    global _extract_pool, _download_pool
+    if _extract_pool is not None:
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
+        _extract_pool = None
+    if _download_pool is not None:
+        _download_pool.shutdown(wait=False, cancel_futures=True)
+        _download_pool = None
+
+def _import_yt_dlp():
+    started = time.monotonic()
+    import yt_dlp  # noqa: F401
+    return time.monotonic() - started
+
+def _extractor_ydl(route=0):
+    # One long-lived YoutubeDL per extract thread and route (it is not
+    # thread-safe), so extractor instances and their caches carry over between requests
+    ydls = _thread_state.__dict__.setdefault('ydls', {})
+    ydl = ydls.get(route)
+    if ydl is None:
+        from yt_dlp import YoutubeDL
+        ydl = ydls[route] = YoutubeDL({
+            'quiet': True,
+            'no_warnings': True,
+            'socket_timeout': SOCKET_TIMEOUT,
+            # Playlists come back as a cheap list of entry URLs; single videos are unaffected
+            'extract_flat': 'in_playlist',
+            'playlistend': BATCH_MAX_ITEMS,
+            **EXTRACT_ROUTES[route],
+        })
+    return ydl
+
+def _extract_info(url, route=0):
+    return _extractor_ydl(route).extract_info(url, download=False)
+
+def _download_video(url, format_spec, outtmpl, timeout, fragments, audio=False, route_opts=None, progress_path=None,
+                    max_filesize=None):
+    # Runs in a pool process. A process cannot be cancelled from the outside,
+    # so the deadline is enforced here by aborting from the progress hook, as
+    # is max_filesize for streams whose size is not known up front; the result
+    # then has 'too_large' set instead of raising.
+    # Options differ per call, so unlike extraction each download gets a fresh
+    # YoutubeDL; the pool initializer has already imported yt-dlp.
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadCancelled
+    started = time.monotonic()
+    deadline = started + timeout
+    stats = {'bytes': 0, 'merge_seconds': 0.0}
+    postprocess_started = {}
+    progress_written = [0.0]
+
+    def on_progress(status):
+        now = time.monotonic()
+        if now > deadline:
+            raise DownloadCancelled(f"Download exceeded {timeout:.0f}s")
+        if max_filesize and status['status'] == 'downloading':
+            fetched = max(status.get('downloaded_bytes') or 0, status.get('total_bytes') or 0)
+            if stats['bytes'] + fetched > max_filesize:
+                stats['too_large'] = True
+                raise DownloadCancelled(f"Download exceeded {max_filesize} bytes")
+        if status['status'] == 'finished':
+            stats['bytes'] += status.get('total_bytes') or status.get('downloaded_bytes') or 0
+        elif progress_path and status['status'] == 'downloading' and now - progress_written[0] >= 1:
+            # The parent polls this file for the status message; a torn read is just skipped
+            progress_written[0] = now
+            with open(progress_path, 'w') as f:
+                json.dump({
+                    'downloaded': status.get('downloaded_bytes') or 0,
+                    'total': status.get('total_bytes') or status.get('total_bytes_estimate'),
+                    'speed': status.get('speed'),
+                    'eta': status.get('eta'),
+                    'done_before': stats['bytes'],  # earlier streams of a video+audio download
+                }, f)
+
+    def on_postprocess(status):
+        if status['status'] == 'started':
+            postprocess_started[status['postprocessor']] = time.monotonic()
+        elif status['status'] == 'finished' and status['postprocessor'] in postprocess_started:
+            stats['merge_seconds'] += time.monotonic() - postprocess_started.pop(status['postprocessor'])
+
+    class OversizeLogger:
+        # yt-dlp reports a known Content-Length over max_filesize only as a
+        # screen message and skips the file; everything else stays quiet
+        def debug(self, message):
+            if 'larger than max-filesize' in message:
+                stats['too_large'] = True
+
+        def info(self, message):
+            pass
+
+        warning = error = info
+
+    ydl_opts = {
+        'format': format_spec,
+        'outtmpl': outtmpl,
+        'max_filesize': max_filesize,
+        'logger': OversizeLogger(),
+        'concurrent_fragment_downloads': fragments,
+        'socket_timeout': SOCKET_TIMEOUT,
+        'quiet': True,
+        'noprogress': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'progress_hooks': [on_progress],
+        'postprocessor_hooks': [on_postprocess],
+        # Same proxy/cookies as the extraction: signed media URLs are often bound to them
+        **(route_opts or {}),
+    }
+    if audio:
+        # 'best' keeps the source codec: aac lands in .m4a, opus in .opus, both by stream copy
+        ydl_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}]
+    else:
+        ydl_opts['merge_output_format'] = 'mp4'  # the merger stream-copies, it never re-encodes
+    try:
+        with YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url)
+        # Tags for send_audio; plain values so they cross the process boundary
+        stats['duration'] = info.get('duration')
+        stats['title'] = info.get('track') or info.get('title')
+        stats['performer'] = info.get('artist') or info.get('uploader')
+    except Exception as e:
+        if not stats.get('too_large'):
+            # yt-dlp errors carry unpicklable loggers; only the message crosses the process boundary
+            raise RuntimeError(str(e)) from None
+    stats['download_seconds'] = time.monotonic() - started - stats['merge_seconds']
+    return stats
+
+def failure_reason(error):
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return 'timeout'
+    return type(error).__name__
+
+extractions_in_flight = 0
+
+async def run_extract(url, platform='Generic'):
+    global extractions_in_flight
+    loop = asyncio.get_running_loop()
+    # Fails fast with PlatformUnavailable while the platform's circuit is open
+    route, generation = await platform_health.admit(platform)
+    extractions_in_flight += 1
+    try:
+        info = await asyncio.wait_for(
+            loop.run_in_executor(get_extract_pool(), _extract_info, url, route),
+            EXTRACT_TIMEOUT
+        )
+    except Exception as e:
+        platform_health.failed(platform, e, route, generation)
+        raise
+    finally:
+        extractions_in_flight -= 1
+    platform_health.succeeded(platform, generation)
+    return info
+
+async def run_download(url, format_spec, outtmpl, extractor=None, audio=False, progress_path=None, max_filesize=None):
+    global _download_pool
+    loop = asyncio.get_running_loop()
+    route_opts = EXTRACT_ROUTES[platform_health.route(extractor)]
+    try:
+        # Grace period on top of the in-process deadline to cover the final merge
+        return await asyncio.wait_for(
+            loop.run_in_executor(
+                get_download_pool(), _download_video,
+                url, format_spec, outtmpl, DOWNLOAD_TIMEOUT, fragment_concurrency(extractor), audio, route_opts,
+                progress_path, max_filesize
+            ),
+            DOWNLOAD_TIMEOUT + 120
+        )
+    except BrokenProcessPool:
+        # A worker died (OOM, ffmpeg crash); start with a fresh pool next time
+        _download_pool = None
+        raise
+
+# --- Staged Startup ---
+# The bot connects and polls before yt-dlp is loaded, so /start and the menus
+# answer right away. Importing yt-dlp and indexing the URL matcher take a few
+# hundred ms and gate link handling; pre-warming the rest (pattern compiles,
+# one YoutubeDL per extract thread, the download processes) only saves
+# first-use latency, so it backs off while real extractions are running.
+STARTED_AT = time.monotonic()
+extractors_ready = asyncio.Event()
+warmup_task = None
+first_link_done = False
+
+def mark_startup(stage):
+    elapsed = time.monotonic() - STARTED_AT
+    metrics.observe('savvy_startup_seconds', elapsed, stage=stage)
+    logger.info(f"Startup: {stage} ready after {elapsed:.2f}s")
+
+async def until_idle():
+    while extractions_in_flight:
+        await asyncio.sleep(0.1)
+
+async def warm_up_extraction():
+    loop = asyncio.get_running_loop()
+    try:
+        import_seconds = await loop.run_in_executor(get_extract_pool(), _import_yt_dlp)
+        logger.info(f"yt-dlp imported in {import_seconds:.2f}s")
+        mark_startup('yt_dlp')
+        await loop.run_in_executor(get_extract_pool(), url_matcher.build)
+        mark_startup('url_matcher')
+    except Exception as e:
+        logger.error(f"Extraction warm-up failed: {e}")
+    finally:
+        extractors_ready.set()
+
+async def warm_up_extractors():
+    loop = asyncio.get_running_loop()
+    try:
+        for start in range(0, len(url_matcher.extractors), 100):
+            await until_idle()
+            await loop.run_in_executor(get_extract_pool(), url_matcher.compile_all, start, start + 100)
+        mark_startup('url_patterns')
+        await until_idle()
+        # Threads that already hold a YoutubeDL return at once, so this fills most of the pool
+        await asyncio.gather(*(
+            loop.run_in_executor(get_extract_pool(), lambda: _extractor_ydl() and None)
+            for _ in range(EXTRACT_WORKERS)
+        ))
+        mark_startup('extractors')
+    except Exception as e:
+        logger.error(f"Extractor warm-up failed: {e}")
+
+async def warm_up_downloads():
+    # Spawned processes re-import this module and yt-dlp; do it before the first download needs one
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(
+            loop.run_in_executor(get_download_pool(), _import_yt_dlp) for _ in range(DOWNLOAD_WORKERS)
+        ))
+        mark_startup('download_pool')
+    except Exception as e:
+        logger.error(f"Download pool warm-up failed: {e}")
+
+async def warm_up(downloads=True):
+    await warm_up_extraction()
+    await warm_up_extractors()
+    if downloads:
+        # A user needs a few seconds between sending a link and picking a quality
+        await until_idle()
+        await warm_up_downloads()
+
+# --- Caches ---
+# Size-bounded LRU with a per-entry TTL
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+# --- Metadata Cache ---
+# Only the fields the handlers use are kept, so an entry stays a few KB
+FORMAT_FIELDS = ('format_id', 'height', 'width', 'ext', 'vcodec', 'acodec', 'tbr', 'filesize', 'filesize_approx', 'protocol')
+
+metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+def summarize_info(info):
+    if info.get('_type') == 'playlist':
+        entries = [e.get('webpage_url') or e.get('url') for e in info.get('entries') or []]
+        return {
+            'extractor': info.get('extractor_key'),
+            'id': info.get('id'),
+            'title': info.get('title', 'Playlist'),
+            'entries': [url for url in entries if url][:BATCH_MAX_ITEMS],
+        }
+    # Filter valid formats - video formats with height
+    formats = [
+        {k: f.get(k) for k in FORMAT_FIELDS}
+        for f in info.get('formats', [])
+        if f.get('vcodec') != 'none'
+        and f.get('vcodec') is not None
+        and f.get('height')
+    ]
+    duration = info.get('duration') or 0
+    # Size of the audio stream that gets merged into video-only formats
+    audio = [f for f in info.get('formats', []) if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    best_audio = max(audio, key=lambda f: f.get('abr') or f.get('tbr') or 0, default=None)
+    return {
+        'extractor': info.get('extractor_key'),
+        'id': info.get('id'),
+        'title': info.get('title', 'Video'),
+        'duration': duration,
+        'uploader': info.get('uploader', 'Unknown'),
+        'formats': formats,
+        'has_audio_streams': bool(audio),
+        'audio_size': format_size(best_audio, duration) if best_audio else 0,
+    }
+
+# --- URL Matching ---
+# Links are checked against yt-dlp's own extractor patterns before anything
+# expensive runs. The top platforms take a regex fast path; everything else
+# only tries the extractors whose pattern mentions one of the link's host
+# labels, so junk is rejected without scanning all ~1800 patterns.
+# Share/tracking parameters that never select a different video
+TRACKING_PARAMS = re.compile(r'^(utm_\w+|fbclid|gclid|igshid|igsh|si|feature|ref_src|ref_url|is_from_webapp|sender_device)$')
+HOST_STOPWORDS = {'www', 'm', 'mobile', 'com', 'net', 'org', 'co', 'tv'}
+MOBILE_HOSTS = {
+    'mobile.twitter.com': 'twitter.com',
+    'mobile.x.com': 'x.com',
+    'm.facebook.com': 'www.facebook.com',
+    'm.vk.com': 'vk.com',
+    'm.dailymotion.com': 'www.dailymotion.com',
+}
+FAST_PATTERNS = (
+    ('Youtube', re.compile(
+        # Links with a list= go the slow way: they may be playlists
+        r'^(?!.*[?&]list=)https?://(?:(?:www|m|music)\.)?(?:youtube\.com/(?:watch\?(?:[^#]*?&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)'
+        r'(?!live_stream|videoseries)(?P<id>[0-9A-Za-z_-]{11})(?:[?&#/]|$)'
+    ), 'https://www.youtube.com/watch?v={id}'),
+    ('TikTok', re.compile(r'^https?://www\.tiktok\.com/@[\w.-]+/video/(?P<id>\d+)'), None),
+    ('Instagram', re.compile(r'^https?://(?:www\.)?instagram\.com/(?:[^/]+/)?(?:p|reels?|tv)/(?P<id>[^/?#&]+)'), None),
+    ('Twitter', re.compile(r'^https?://(?:www\.)?(?:twitter|x)\.com/(?:i/web|[^/]+)/status/(?P<id>\d+)'), None),
+)
+
+def canonicalize_url(url):
+    url = url.strip()
+    if not url or any(c.isspace() for c in url):
+        return None
+    if '://' not in url:
+        url = 'https://' + url
+    try:
+        parsed = urlparse(url)
+        port = parsed.port
+    except ValueError:
+        return None
+    if parsed.scheme.lower() not in ('http', 'https') or not parsed.hostname:
+        return None
+    host = parsed.hostname.lower()
+    host = MOBILE_HOSTS.get(host, host)
+    netloc = host if port is None else f"{host}:{port}"
+    query = '&'.join(
+        part for part in parsed.query.split('&')
+        if part and not TRACKING_PARAMS.match(part.split('=', 1)[0])
+    )
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=netloc, query=query, fragment='').geturl()
+
+class UrlMatcher:
+    def __init__(self):
+        self.extractors = []
+        self._by_literal = {}
+        self._hostless = []
+        self._candidates = TTLCache(4096, float('inf'))
+
+    def build(self):
+        from yt_dlp.extractor import gen_extractor_classes
+        literals = re.compile(r'[a-z0-9]+')
+        for ie in gen_extractor_classes():
+            patterns = ie._VALID_URL
+            if ie.ie_key() == 'Generic' or not patterns:
+                continue
+            index = len(self.extractors)
+            self.extractors.append(ie)
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            for pattern in patterns:
+                # Drop escapes like \d and optional characters ("tiktokv?") so
+                # neither sticks to a neighbouring literal
+                source = re.sub(r'\\[a-zA-Z]|[a-z0-9]\?', ' ', pattern.lower())
+                host = source.split('://', 1)[-1].split('/', 1)[0]
+                if not set(literals.findall(host)) - {'www', 'http', 'id', 'p', 'x'}:
+                    # e.g. https?://[^/]+/... matches any host
+                    self._hostless.append(index)
+                for literal in set(literals.findall(source)):
+                    self._by_literal.setdefault(literal, []).append(index)
+        logger.info(f"URL matcher ready: {len(self.extractors)} extractors, {len(self._by_literal)} literals")
+
+    def compile_all(self, start=0, stop=None):
+        # Patterns otherwise compile on first use; all of them take ~0.5s, so this runs after startup
+        for ie in self.extractors[start:stop]:
+            try:
+                ie.suitable('')  # compiles and caches the pattern on the class
+            except Exception:
+                pass
+
+    def candidates(self, host):
+        labels = tuple(label for label in host.split('.')[:-1] if label not in HOST_STOPWORDS)
+        found = self._candidates.get(labels)
+        if found is None:
+            # Alternations split host names across literals ("bili(?:bili\.tv|intl\.com)"),
+            # so a label matches every literal it contains, not only an equal one
+            indexes = set(self._hostless)
+            for label in labels:
+                parts = set(label.split('-'))
+                for literal, owners in self._by_literal.items():
+                    if literal in parts or (len(literal) > 2 and literal in label):
+                        indexes.update(owners)
+            # Keep yt-dlp's order: more specific extractors come first
+            found = [self.extractors[i] for i in sorted(indexes)]
+            self._candidates.put(labels, found)
+        return found
+
+    def match(self, url):
+        # (extractor, video id) and the canonical URL, or None when no extractor accepts the link
+        url = canonicalize_url(url)
+        if url is None:
+            return None
+        for ie_key, pattern, template in FAST_PATTERNS:
+            m = pattern.match(url)
+            if m:
+                return (ie_key, m.group('id')), template.format(id=m.group('id')) if template else url
+        host = urlparse(url).hostname
+        if host in EXTRA_SUPPORTED_HOSTS:
+            return ('Generic', url), url
+        for ie in self.candidates(host):
+            if ie.suitable(url):
+                try:
+                    video_id = ie.get_temp_id(url)
+                except Exception:
+                    video_id = None
+                return (ie.ie_key(), video_id or url), url
+        return None
+
+url_matcher = UrlMatcher()
+
+# --- Link Sessions ---
+# Every analysed link gets its own session so the buttons under each message
+# keep downloading that message's video, however many links the user sends.
+# callback_data is "dl_<token>_<quality>" ("dlb_" for batches), well under
+# Telegram's 64 bytes.
+sessions = TTLCache(SESSION_CACHE_SIZE, SESSION_TTL)
+
+def session_entry(url, key, info, choices):
+    return {
+        'url': url,
+        'key': key,
+        'title': info['title'],
+        'formats': {res: spec for res, (spec, _) in choices.items()},
+        'sizes': {res: size for res, (_, size) in choices.items()},
+    }
+
+def new_session(data):
+    # 64 random bits: with SESSION_CACHE_SIZE live sessions a new token
+    # practically never lands on (and overwrites) another user's
+    token = secrets.token_hex(8)
+    sessions.put(token, data)
+    return token
+
+def parse_download_data(data):
+    # "dl_<token>_<quality>" / "dlb_<token>_<quality>" -> (session or None, quality)
+    _, token, quality = (data.split('_', 2) + ['', ''])[:3]
+    return sessions.get(token), quality
+
+# --- Scratch Space ---
+# Downloads land in a dedicated directory. Each job reserves its estimated
+# footprint up front; jobs that would overrun the quota wait for space, and
+# jobs that could never fit are refused before any bytes are fetched.
+UUID_FILE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}[.\w-]*$')
+
+class ScratchFull(Exception):
+    pass
+
+class ScratchSpace:
+    def __init__(self, path, quota):
+        self.path = path
+        self.quota = quota
+        self.reserved = 0
+        self._changed = asyncio.Condition()
+
+    def sweep(self):
+        # Files left behind by a crash or restart mid-download, including the
+        # /tmp/<uuid>* files of older versions
+        os.makedirs(self.path, exist_ok=True)
+        removed = 0
+        for directory, pattern in ((self.path, None), ('/tmp', UUID_FILE)):
+            for name in os.listdir(directory):
+                file = os.path.join(directory, name)
+                if (pattern and not pattern.match(name)) or not os.path.isfile(file) or name.endswith('.lock'):
+                    continue  # worker directories and their locks are handled by isolate()
+                try:
+                    os.remove(file)
+                    removed += 1
+                except OSError as e:
+                    logger.warning(f"Could not remove orphaned file {file}: {e}")
+        if removed:
+            logger.info(f"Removed {removed} orphaned scratch files")
+
+    def isolate(self, name):
+        # For worker processes sharing SCRATCH_DIR: move into <path>/<name>,
+        # held by a lock for the lifetime of the process. Directories whose lock
+        # is free belong to workers that are gone and are removed; nothing of a
+        # running worker is touched.
+        os.makedirs(self.path, exist_ok=True)
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.lock'):
+                continue
+            with open(entry.path, 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(entry.path[:-len('.lock')], ignore_errors=True)
+                os.remove(entry.path)
+                logger.info(f"Removed scratch files of stopped worker {entry.name[:-len('.lock')]}")
+        self._lock = open(os.path.join(self.path, f"{name}.lock"), 'a')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self.path = os.path.join(self.path, name)
+        os.makedirs(self.path, exist_ok=True)
+
+    def used(self):
+        total = 0
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return 0  # the queue-mode frontend never creates its scratch dir
+        for entry in entries:
+            try:
+                total += entry.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    @asynccontextmanager
+    async def reserve(self, nbytes):
+        if nbytes > self.quota:
+            raise ScratchFull()
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.reserved + nbytes <= self.quota)
+            self.reserved += nbytes
+        try:
+            yield os.path.join(self.path, str(uuid4()))
+        finally:
+            async with self._changed:
+                self.reserved -= nbytes
+                self._changed.notify_all()
+
+    def stats(self):
+        return {'used': self.used(), 'reserved': self.reserved, 'quota': self.quota}
+
+scratch = ScratchSpace(SCRATCH_DIR, SCRATCH_QUOTA)
+
+def format_size(f, duration):
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = f['tbr'] * 125 * duration  # tbr is kbit/s
+    return int(size) if size else None
+
+def estimate_download_size(f, info):
+    size = format_size(f, info['duration'])
+    if size and f.get('acodec') in (None, 'none'):
+        # Video-only format: the best audio stream is merged in
+        size += info.get('audio_size') or 0
+    return size
+
+def human_size(nbytes):
+    if nbytes >= 1024 ** 3:
+        return f"{nbytes / 1024 ** 3:.1f} GB"
+    return f"{nbytes / 1024 ** 2:.0f} MB"
+
+# --- Format Selection ---
+# Prefer progressive formats (video + audio in one file): no second download
+# and no merge. Otherwise pair video with audio for a stream-copy remux into
+# mp4, preferring m4a audio which mp4 carries natively.
+PROTOCOL_RANK = {'https': 2, 'http': 2, 'm3u8_native': 1, 'm3u8': 1, 'http_dash_segments': 1}
+
+def format_rank(f):
+    return (f.get('ext') == 'mp4', PROTOCOL_RANK.get(f.get('protocol'), 0), f.get('tbr') or 0)
+
+def select_formats(info):
+    # Returns {"720p": (format spec, estimated size)}
+    by_height = {}
+    for f in info['formats']:
+        by_height.setdefault(f['height'], []).append(f)
+    choices = {}
+    for height, candidates in by_height.items():
+        progressive = [f for f in candidates if f.get('acodec') not in (None, 'none')]
+        if progressive:
+            f = max(progressive, key=format_rank)
+            spec = f['format_id']
+        else:
+            f = max(candidates, key=format_rank)
+            if f.get('acodec') == 'none' and info.get('has_audio_streams'):
+                fid = f['format_id']
+                spec = f"{fid}+bestaudio[ext=m4a]/{fid}+bestaudio/best[height<={height}]"
+            else:
+                spec = f['format_id']
+        choices[f"{height}p"] = (spec, estimate_download_size(f, info))
+    return choices
+
+# Audio-only: the best audio stream, remuxed (never re-encoded) by
+# FFmpegExtractAudio into m4a/opus. Sites without separate audio streams fall
+# back to the best progressive file and have its audio track copied out.
+AUDIO_QUALITY = 'audio'
+AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/best'
+
+def audio_choice(info):
+    # (format spec, estimated size) for the "🎵 Audio" option
+    return AUDIO_FORMAT, (info['audio_size'] or None) if info.get('has_audio_streams') else None
+
+def fragment_concurrency(extractor):
+    return FRAGMENT_CONCURRENCY.get(extractor, FRAGMENT_CONCURRENCY_DEFAULT)
+
+# --- Database ---
+_db = None
+
+def get_db():
+    # Opened lazily so download worker processes never touch the database
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_PATH, check_same_thread=False)
+        # WAL: readers never block the writer and commits are a sequential append
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+    return _db
+
+def close_db():
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
+# --- State Store ---
+# Users, channels and welcome config survive restarts. New users arrive on
+# the hot path and are buffered in memory, then written in batches by a
+# background flusher; admin edits are rare and written through immediately.
+class StateStore:
+    def __init__(self, db):
+        self.db = db
+        self._added = set()
+        self._removed = set()
+        self._flusher = None
+        # INTEGER PRIMARY KEY makes the user id the rowid itself: one compact b-tree, no extra index
+        db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY)")
+        db.execute("CREATE TABLE IF NOT EXISTS channels (entry TEXT PRIMARY KEY, chat_id TEXT NOT NULL, position INTEGER NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.commit()
+
+    def load(self):
+        global initial_welcome_text, welcome_text, welcome_media
+        user_ids.update(row[0] for row in self.db.execute("SELECT id FROM users"))
+        for entry, chat_id in self.db.execute("SELECT entry, chat_id FROM channels ORDER BY position"):
+            required_channels.append(entry)
+            channel_chat_ids[entry] = chat_id
+        settings = {key: json.loads(value) for key, value in self.db.execute("SELECT key, value FROM settings")}
+        initial_welcome_text = settings.get('initial_welcome_text', initial_welcome_text)
+        welcome_text = settings.get('welcome_text', welcome_text)
+        if settings.get('welcome_media'):
+            welcome_media = tuple(settings['welcome_media'])
+        logger.info(f"Loaded {len(user_ids)} users and {len(required_channels)} channels")
+
+    def add_user(self, uid):
+        self._removed.discard(uid)
+        self._added.add(uid)
+
+    def remove_user(self, uid):
+        self._added.discard(uid)
+        self._removed.add(uid)
+
+    def flush(self):
+        if not self._added and not self._removed:
+            return
+        added, self._added = self._added, set()
+        removed, self._removed = self._removed, set()
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO users (id) VALUES (?)", ((uid,) for uid in added))
+            self.db.executemany("DELETE FROM users WHERE id = ?", ((uid,) for uid in removed))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"State flush failed: {e}")
+
+    def start(self):
+        self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self.flush()
+
+    def set_setting(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, json.dumps(value)))
+
+    def save_channels(self):
+        with self.db:
+            self.db.execute("DELETE FROM channels")
+            self.db.executemany(
+                "INSERT INTO channels VALUES (?, ?, ?)",
+                ((entry, channel_chat_ids[entry], i) for i, entry in enumerate(required_channels))
+            )
+
+state_store = None  # StateStore, created on startup
+
+def remember_user(uid):
+    if uid not in user_ids:
+        user_ids.add(uid)
+        state_store.add_user(uid)
+
+def forget_user(uid):
+    user_ids.discard(uid)
+    state_store.remove_user(uid)
+
+# --- File ID Cache ---
+# Telegram keeps every uploaded file; re-sending its file_id is a single API
+# call, so a repeat request skips the download, merge and upload entirely.
+# A split file is cached as the list of its parts' file_ids, space-separated.
+class FileIdCache:
+    def __init__(self, db):
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS file_cache ("
+            "extractor TEXT NOT NULL, video_id TEXT NOT NULL, quality TEXT NOT NULL, "
+            "file_id TEXT NOT NULL, file_size INTEGER NOT NULL, created REAL NOT NULL, "
+            "PRIMARY KEY (extractor, video_id, quality)) WITHOUT ROWID"
+        )
+        db.commit()
+
+    def get(self, key, quality):
+        row = self.db.execute(
+            "SELECT file_id, file_size FROM file_cache WHERE extractor = ? AND video_id = ? AND quality = ?",
+            (key[0], key[1], quality)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        file_id, file_size = row
+        return (file_id.split(' ') if ' ' in file_id else file_id), file_size
+
+    def has(self, key, quality):
+        # Like get, but does not count towards the hit rate
+        return self.db.execute(
+            "SELECT 1 FROM file_cache WHERE extractor = ? AND video_id = ? AND quality = ?",
+            (key[0], key[1], quality)
+        ).fetchone() is not None
+
+    def put(self, key, quality, file_id, file_size):
+        self.db.execute(
+            "INSERT OR REPLACE INTO file_cache VALUES (?, ?, ?, ?, ?, ?)",
+            (key[0], key[1], quality, ' '.join(file_id) if isinstance(file_id, list) else file_id, file_size, time.time())
+        )
+        self.db.commit()
+
+    def invalidate(self, key, quality):
+        self.db.execute(
+            "DELETE FROM file_cache WHERE extractor = ? AND video_id = ? AND quality = ?",
+            (key[0], key[1], quality)
+        )
+        self.db.commit()
+
+    def stats(self):
+        count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM file_cache").fetchone()
+        return {'entries': count, 'bytes': total, 'hits': self.hits, 'misses': self.misses}
+
+file_cache = None  # FileIdCache, created on startup
+
+# --- Distributed Job Queue ---
+# With JOB_QUEUE_URL set, the bot only enqueues download jobs; worker
+# processes (`python bot.py worker`, any number, on any host that can reach
+# the queue) claim them, download, upload straight to the user's chat and
+# report the resulting file_id back. Jobs whose worker stops heartbeating are
+# put back in the queue.
+class SqliteJobQueue:
+    # sqlite3 blocks, and a busy database (workers writing) can stall a call for
+    # up to the 30s busy timeout, so every query runs on one dedicated thread
+    # that also serialises use of the shared connection
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, priority INTEGER NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'queued', worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, created REAL NOT NULL, heartbeat REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, priority, id)")
+        self.db.commit()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobqueue")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def enqueue(self, job, priority=1):
+        return await self._run(self._enqueue, job, priority)
+
+    def _enqueue(self, job, priority):
+        with self.db:
+            cur = self.db.execute(
+                "INSERT INTO jobs (priority, payload, created) VALUES (?, ?, ?)",
+                (priority, json.dumps(job), time.time())
+            )
+        return str(cur.lastrowid)
+
+    async def claim(self, worker_id):
+        return await self._run(self._claim, worker_id)
+
+    def _claim(self, worker_id):
+        # A single UPDATE ... RETURNING is atomic, so two workers never claim the same job
+        with self.db:
+            row = self.db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, heartbeat = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY priority, id LIMIT 1) "
+                "RETURNING id, payload",
+                (worker_id, time.time())
+            ).fetchone()
+        return (str(row[0]), json.loads(row[1])) if row else None
+
+    async def heartbeat(self, job_id):
+        await self._run(self._write, "UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), int(job_id)))
+
+    async def finish(self, job_id, status, result):
+        await self._run(
+            self._write, "UPDATE jobs SET status = ?, result = ? WHERE id = ?", (status, json.dumps(result), int(job_id))
+        )
+
+    async def requeue(self, job_id):
+        await self._run(self._write, "UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ?", (int(job_id),))
+
+    async def cancel(self, job_id):
+        # Only a job no worker has claimed yet can be withdrawn
+        await self._run(
+            self._write, "UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status = 'queued'", (int(job_id),)
+        )
+
+    def _write(self, sql, params):
+        with self.db:
+            self.db.execute(sql, params)
+
+    async def get(self, job_id):
+        row = await self._run(self._fetch, "SELECT status, result FROM jobs WHERE id = ?", (int(job_id),))
+        return (row[0], json.loads(row[1]) if row[1] else None) if row else (None, None)
+
+    async def position(self, job_id):
+        row = await self._run(
+            self._fetch,
+            "SELECT COUNT(*) FROM jobs AS q, jobs AS j WHERE j.id = ? AND j.status = 'queued' "
+            "AND q.status = 'queued' AND (q.priority < j.priority OR (q.priority = j.priority AND q.id <= j.id))",
+            (int(job_id),)
+        )
+        return row[0]
+
+    async def depth(self):
+        return (await self._run(self._fetch, "SELECT COUNT(*) FROM jobs WHERE status = 'queued'", ()))[0]
+
+    def _fetch(self, sql, params):
+        return self.db.execute(sql, params).fetchone()
+
+    async def recover_stale(self, stale_after, max_attempts):
+        return await self._run(self._recover_stale, stale_after, max_attempts)
+
+    def _recover_stale(self, stale_after, max_attempts):
+        cutoff = time.time() - stale_after
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = 'failed', result = ? "
+                "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                (json.dumps({'error': 'failed', 'message': 'worker lost'}), cutoff, max_attempts)
+            )
+            stale = self.db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat < ?",
+                (cutoff,)
+            ).rowcount
+            # Finished jobs only need to live until the frontend has read them
+            self.db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND created < ?", (time.time() - 86400,)
+            )
+        return stale
+
+class RedisJobQueue:
+    # One list per priority (BRPOP checks keys in order), a hash per job and a
+    # sorted set of running jobs scored by their last heartbeat
+    def __init__(self, url, prefix='savvy'):
+        import redis.asyncio as redis  # optional dependency, only needed for this backend
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _queue(self, priority):
+        return f"{self.prefix}:queue:{priority}"
+
+    def _job(self, job_id):
+        return f"{self.prefix}:job:{job_id}"
+
+    async def enqueue(self, job, priority=1):
+        job_id = str(await self.redis.incr(f"{self.prefix}:seq"))
+        await self.redis.hset(self._job(job_id), mapping={
+            'payload': json.dumps(job), 'priority': priority, 'status': 'queued', 'attempts': 0, 'created': time.time()
+        })
+        await self.redis.lpush(self._queue(priority), job_id)
+        return job_id
+
+    async def claim(self, worker_id):
+        popped = await self.redis.brpop([self._queue(0), self._queue(1)], timeout=1)
+        if popped is None:
+            return None
+        job_id = popped[1]
+        await self.redis.hset(self._job(job_id), mapping={'status': 'running', 'worker': worker_id})
+        await self.redis.hincrby(self._job(job_id), 'attempts', 1)
+        await self.redis.zadd(f"{self.prefix}:running", {job_id: time.time()})
+        return job_id, json.loads(await self.redis.hget(self._job(job_id), 'payload'))
+
+    async def heartbeat(self, job_id):
+        await self.redis.zadd(f"{self.prefix}:running", {job_id: time.time()})
+
+    async def finish(self, job_id, status, result):
+        await self.redis.hset(self._job(job_id), mapping={'status': status, 'result': json.dumps(result)})
+        await self.redis.expire(self._job(job_id), 86400)
+        await self.redis.zrem(f"{self.prefix}:running", job_id)
+
+    async def requeue(self, job_id):
+        await self.redis.zrem(f"{self.prefix}:running", job_id)
+        await self.redis.hset(self._job(job_id), 'status', 'queued')
+        await self.redis.rpush(self._queue(int(await self.redis.hget(self._job(job_id), 'priority'))), job_id)
+
+    async def cancel(self, job_id):
+        # BRPOP and LREM are atomic, so the job is either claimed or withdrawn, never both
+        priority = int(await self.redis.hget(self._job(job_id), 'priority'))
+        if await self.redis.lrem(self._queue(priority), 0, job_id):
+            await self.redis.hset(self._job(job_id), 'status', 'cancelled')
+            await self.redis.expire(self._job(job_id), 86400)
+
+    async def get(self, job_id):
+        status, result = await self.redis.hmget(self._job(job_id), ['status', 'result'])
+        return status, json.loads(result) if result else None
+
+    async def position(self, job_id):
+        priority = int(await self.redis.hget(self._job(job_id), 'priority'))
+        index = await self.redis.lpos(self._queue(priority), job_id)
+        if index is None:
+            return 0
+        ahead = await self.redis.llen(self._queue(priority)) - index
+        for higher in range(priority):
+            ahead += await self.redis.llen(self._queue(higher))
+        return ahead
+
+    async def depth(self):
+        return await self.redis.llen(self._queue(0)) + await self.redis.llen(self._queue(1))
+
+    async def recover_stale(self, stale_after, max_attempts):
+        stale = 0
+        for job_id in await self.redis.zrangebyscore(f"{self.prefix}:running", 0, time.time() - stale_after):
+            if int(await self.redis.hget(self._job(job_id), 'attempts') or 0) >= max_attempts:
+                await self.finish(job_id, 'failed', {'error': 'failed', 'message': 'worker lost'})
+            else:
+                await self.requeue(job_id)
+                stale += 1
+        return stale
+
+def open_job_queue(url):
+    if url.startswith('sqlite:///'):
+        # Like a file:// URL the path keeps its leading slash: sqlite:///var/lib/jobs.db
+        return SqliteJobQueue(urlparse(url).path)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisJobQueue(url)
+    raise ValueError(f"Unsupported JOB_QUEUE_URL: {url}")
+
+job_queue = None  # SqliteJobQueue / RedisJobQueue when JOB_QUEUE_URL is set
+
+# --- Rate Limiting ---
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # At least one whole token, or rates below 1/s could never be acquired
+        self.capacity = max(1, capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def try_acquire(self):
+        # Takes a token only if one is available right now
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def pause(self, seconds):
+        # Flood control from Telegram applies to the whole bot: drain the bucket
+        # so every sender waits, not just the one that was told to retry
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, 'total_seconds') else float(delay)
+
+# --- Platform Health ---
+# Each extractor (platform) gets its own request rate, and a run of 429s or
+# bot checks slows it down exponentially, moves it to the next proxy/cookie
+# route and finally opens a circuit: new links for that platform fail fast
+# until one probe after the backoff gets through. Errors about the video
+# itself (private, removed, geo-blocked) say nothing about the platform.
+EXTRACT_ROUTES = [
+    {k: v for k, v in (('proxy', proxy), ('cookiefile', cookies)) if v}
+    for proxy in EXTRACT_PROXIES or [None]
+    for cookies in EXTRACT_COOKIE_FILES or [None]
+]
+BLOCK_PATTERNS = (
+    ('rate_limited', re.compile(r'429|too many requests|rate.?limit', re.I)),
+    ('bot_check', re.compile(r'not a bot|captcha|login required|HTTP Error 403', re.I)),
+    ('network', re.compile(r'timed out|connection (?:reset|refused|aborted)|temporary failure|HTTP Error 5\d\d', re.I)),
+)
+
+def classify_error(error):
+    # 'rate_limited', 'bot_check' and 'network' count against the platform; 'video' does not
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return 'network'
+    message = str(error)
+    for kind, pattern in BLOCK_PATTERNS:
+        if pattern.search(message):
+            return kind
+    return 'video'
+
+class PlatformUnavailable(Exception):
+    def __init__(self, platform, retry_in):
+        super().__init__(f"{platform} is backing off for {retry_in:.0f}s")
+        self.platform = platform
+        self.retry_in = retry_in
+
+class PlatformState:
+    def __init__(self, platform):
+        self.bucket = TokenBucket(PLATFORM_RATES.get(platform, PLATFORM_RATE_DEFAULT))
+        self.failures = 0  # consecutive platform-level failures
+        self.open_until = 0.0
+        self.route = 0
+        # Bumped per counted failure: requests admitted before it belong to the
+        # same burst and must not count (or rotate the route) again
+        self.generation = 0
+
+class PlatformHealth:
+    def __init__(self):
+        self._states = {}
+
+    def state(self, platform):
+        state = self._states.get(platform)
+        if state is None:
+            state = self._states[platform] = PlatformState(platform)
+        return state
+
+    def route(self, platform):
+        state = self._states.get(platform)
+        return state.route if state else 0
+
+    async def admit(self, platform):
+        # Waits for the platform's rate, or raises PlatformUnavailable while its circuit is open.
+        # Returns the route to use and the generation to report back with.
+        state = self.state(platform)
+        if state.failures >= PLATFORM_BREAKER_THRESHOLD:
+            now = time.monotonic()
+            if state.open_until > now:
+                raise PlatformUnavailable(platform, state.open_until - now)
+            # Half-open: this request probes, the rest keep failing until it reports back
+            state.open_until = now + EXTRACT_TIMEOUT
+        try:
+            await asyncio.wait_for(state.bucket.acquire(), PLATFORM_MAX_WAIT)
+        except asyncio.TimeoutError:
+            # Backed off or over its rate for longer than a user should watch "Analyzing..."
+            raise PlatformUnavailable(platform, PLATFORM_MAX_WAIT) from None
+        return state.route, state.generation
+
+    def succeeded(self, platform, generation):
+        state = self.state(platform)
+        if generation != state.generation:
+            return  # started before the latest failure, says nothing about now
+        if state.failures:
+            logger.info(f"{platform} recovered after {state.failures} failures")
+        state.failures = 0
+
+    def failed(self, platform, error, route, generation):
+        state = self.state(platform)
+        kind = classify_error(error)
+        metrics.inc('savvy_platform_errors_total', platform=platform, kind=kind)
+        if generation != state.generation:
+            return  # part of a burst that has already been counted
+        if kind == 'video':
+            state.failures = 0
+            return
+        state.generation += 1
+        state.failures += 1
+        backoff = min(PLATFORM_BACKOFF_MAX, PLATFORM_BACKOFF_BASE * 2 ** (state.failures - 1))
+        if kind != 'network' and route == state.route and len(EXTRACT_ROUTES) > 1:
+            state.route = (state.route + 1) % len(EXTRACT_ROUTES)
+        if state.failures >= PLATFORM_BREAKER_THRESHOLD:
+            state.open_until = time.monotonic() + backoff
+            logger.warning(f"{platform} circuit open for {backoff:.0f}s after {state.failures} failures ({kind})")
+        else:
+            # Slow every caller down, not just the next one
+            state.bucket.pause(backoff)
+
+    def summary(self):
+        now = time.monotonic()
+        lines = []
+        for platform, state in sorted(self._states.items()):
+            if state.failures >= PLATFORM_BREAKER_THRESHOLD:
+                lines.append(f"🔴 {platform}: open, retry in {max(0, state.open_until - now):.0f}s")
+            elif state.failures:
+                lines.append(f"🟡 {platform}: {state.failures} recent failures")
+        return lines
+
+platform_health = PlatformHealth()
+
+# --- Progress Updates ---
+# Status messages show download and upload progress, but every edit is an API
+# call: edits are dropped rather than queued when the chat was edited less
+# than PROGRESS_INTERVAL ago or the global budget is spent. The next tick
+# shows the latest state anyway, so nothing is lost but intermediate frames.
+class ProgressEditor:
+    def __init__(self, rate, interval):
+        self.budget = TokenBucket(rate)
+        self._recent = TTLCache(100000, interval)  # chats edited within the interval
+
+    async def edit(self, bot, chat_id, message_id, text):
+        if self._recent.get(chat_id) or not self.budget.try_acquire():
+            return
+        self._recent.put(chat_id, True)
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except RetryAfter as e:
+            self.budget.pause(retry_after_seconds(e))
+        except (BadRequest, NetworkError):
+            pass  # unchanged text, deleted message, or a transient error: the next tick retries
+
+progress_editor = ProgressEditor(PROGRESS_EDIT_RATE, PROGRESS_INTERVAL)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def download_progress_text(quality, path):
+    try:
+        with open(path) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    done = status['done_before'] + status['downloaded']
+    total = status['total'] and status['done_before'] + status['total']
+    lines = [f"⬇️ Downloading in {quality}..."]
+    if total:
+        percent = min(100, int(100 * done / total))
+        lines[0] += f" {percent}%"
+        lines.append("▰" * (percent // 10) + "▱" * (10 - percent // 10))
+        lines.append(f"📦 {done / 1024 ** 2:.1f} / {total / 1024 ** 2:.1f} MB")
+    else:
+        lines.append(f"📦 {done / 1024 ** 2:.1f} MB")
+    if status['speed']:
+        lines[-1] += f" · 🚀 {status['speed'] / 1024 ** 2:.1f} MB/s"
+    if status['eta'] is not None:
+        lines[-1] += f" · ⏳ {format_duration(status['eta'])}"
+    return "\n".join(lines)
+
+@asynccontextmanager
+async def live_status(bot, chat_id, message_id, render):
+    # While the body runs, edits the status message with render()'s text every tick
+    async def refresh():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            text = render()
+            if text:
+                await progress_editor.edit(bot, chat_id, message_id, text)
+
+    task = asyncio.create_task(refresh()) if message_id else None
+    try:
+        yield
+    finally:
+        if task:
+            task.cancel()
+
+# --- Broadcast Engine ---
+# Users are visited in ascending id order and the highest finished id is
+# checkpointed after every chunk, so a restart resumes where it stopped.
+class BroadcastEngine:
+    def __init__(self, bot, db):
+        self.bot = bot
+        self.db = db
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self._tasks = set()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "id INTEGER PRIMARY KEY, from_chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+            "status_chat_id INTEGER NOT NULL, status_message_id INTEGER NOT NULL, "
+            "cursor INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, "
+            "delivered INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "blocked INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'running')"
+        )
+        db.commit()
+
+    def create(self, from_chat_id, message_id, status_chat_id, status_message_id):
+        cur = self.db.execute(
+            "INSERT INTO broadcasts (from_chat_id, message_id, status_chat_id, status_message_id, total) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (from_chat_id, message_id, status_chat_id, status_message_id, len(user_ids))
+        )
+        self.db.commit()
+        return cur.lastrowid
+
+    def start(self, broadcast_id):
+        task = asyncio.get_running_loop().create_task(self.run(broadcast_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def resume_all(self):
+        for (broadcast_id,) in self.db.execute("SELECT id FROM broadcasts WHERE status = 'running'").fetchall():
+            logger.info(f"Resuming broadcast {broadcast_id}")
+            self.start(broadcast_id)
+
+    def stop_all(self):
+        # Running broadcasts keep status 'running' and resume on next start
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _send(self, uid, from_chat_id, message_id):
+        for attempt in range(BROADCAST_RETRIES):
+            await self.bucket.acquire()
+            try:
+                await self.bot.copy_message(uid, from_chat_id, message_id)
+                return 'delivered'
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self.bucket.pause(delay)
+                await asyncio.sleep(delay)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return 'blocked'
+                logger.warning(f"Broadcast to {uid} rejected: {e}")
+                return 'failed'
+            except NetworkError as e:
+                logger.warning(f"Broadcast to {uid} network error (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Broadcast failed for user {uid}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def _report(self, row, done):
+        _, _, _, status_chat_id, status_message_id, _, total, delivered, failed, blocked, status = row
+        header = "✅ Broadcast complete!" if done else "📢 Broadcasting..."
+        processed = delivered + failed + blocked
+        percent = processed * 100 // total if total else 100
+        try:
+            await self.bot.edit_message_text(
+                f"{header}\n\n"
+                f"📊 Progress: {processed}/{total} ({percent}%)\n"
+                f"📤 Delivered: {delivered}\n❌ Failed: {failed}\n🚫 Blocked (removed): {blocked}",
+                chat_id=status_chat_id,
+                message_id=status_message_id
+            )
+        except BadRequest:
+            pass  # "message is not modified"
+        except Exception as e:
+            logger.warning(f"Broadcast progress update failed: {e}")
+
+    def _load(self, broadcast_id):
+        return self.db.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+
+    async def run(self, broadcast_id):
+        row = self._load(broadcast_id)
+        from_chat_id, message_id, cursor = row[1], row[2], row[5]
+        targets = sorted(uid for uid in user_ids if uid > cursor)
+        counts = {'delivered': row[7], 'failed': row[8], 'blocked': row[9]}
+        # Users who joined since the start are included, so keep the total honest
+        total = max(row[6], sum(counts.values()) + len(targets))
+        last_report = 0
+        
+        for start in range(0, len(targets), BROADCAST_CHUNK):
+            chunk = targets[start:start + BROADCAST_CHUNK]
+            results = await asyncio.gather(*(self._send(uid, from_chat_id, message_id) for uid in chunk))
+            for uid, result in zip(chunk, results):
+                counts[result] += 1
+                if result == 'blocked':
+                    forget_user(uid)
+            self.db.execute(
+                "UPDATE broadcasts SET cursor = ?, total = ?, delivered = ?, failed = ?, blocked = ? WHERE id = ?",
+                (chunk[-1], total, counts['delivered'], counts['failed'], counts['blocked'], broadcast_id)
+            )
+            self.db.commit()
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await self._report(self._load(broadcast_id), done=False)
+        
+        self.db.execute("UPDATE broadcasts SET status = 'done', total = ? WHERE id = ?", (total, broadcast_id))
+        self.db.commit()
+        row = self._load(broadcast_id)
+        logger.info(f"Broadcast {broadcast_id} finished: {counts}")
+        await self._report(row, done=True)
+
+broadcast_engine = None  # BroadcastEngine, created on startup
+
+# --- Channel Membership ---
+membership_cache = {}  # chat id -> TTLCache of user ids verified as members
+
+def normalize_channel(entry):
+    cid = entry
+    if cid.startswith("http"):
+        cid = "@" + cid.rstrip("/").split("/")[-1]
+    elif not cid.startswith("@"):
+        if not cid.startswith("-"):
+            cid = "@" + cid.lstrip("@")
+    return cid
+
+def invalidate_membership(entry):
+    membership_cache.pop(channel_chat_ids.get(entry) or normalize_channel(entry), None)
+
+async def check_membership(bot, chan, user_id):
+    cid = channel_chat_ids.get(chan) or normalize_channel(chan)
+    cache = membership_cache.get(cid)
+    if cache is None:
+        cache = membership_cache[cid] = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+    if cache.get(user_id):
+        return True
+    try:
+        member = await bot.get_chat_member(cid, user_id)
+    except Exception as e:
+        logger.error(f"Error checking membership for {chan}: {e}")
+        return False
+    if member.status not in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]:
+        return False
+    # Only positive results are cached so a user who just joined is re-checked
+    cache.put(user_id, True)
+    return True
+
 # --- Keyboards ---
 def main_keyboard(user_id):
     keys = [[KeyboardButton("🚀 Start")]]
@@ -57,6 +1722,7 @@ def admin_keyboard():
         ["🎨 Edit Welcome Media"],
         ["➕ Add Channel", "➖ Remove Channel"],
         ["📢 Broadcast", "👥 User Count"],
+        ["💾 Cache Stats", "📊 Stats"],
         ["⬅️ Back"]
     ], resize_keyboard=True)
 
@@ -75,7 +1741,7 @@ def channel_join_keyboard():
 # --- Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_ids.add(user_id)
+    remember_user(user_id)
     
     # Send short initial welcome message
     await update.message.reply_text(
@@ -171,6 +1837,28 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ADMIN_PANEL
 
+    if text == "💾 Cache Stats":
+        meta = metadata_cache.stats()
+        pending = sessions.stats()
+        files = file_cache.stats()
+        disk = scratch.stats()
+        await update.message.reply_text(
+            f"💾 *Cache Stats*\n\n"
+            f"🔍 Metadata: {meta['size']} entries, {meta['hits']} hits / {meta['misses']} misses\n"
+            f"🔗 Link sessions: {pending['size']} pending\n"
+            f"📦 Files: {files['entries']} entries ({files['bytes'] / (1024*1024*1024):.2f} GB), "
+            f"{files['hits']} hits / {files['misses']} misses\n"
+            f"🗄 Scratch: {human_size(disk['used'])} used, {human_size(disk['reserved'])} reserved "
+            f"of {human_size(disk['quota'])}",
+            reply_markup=admin_keyboard(),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return ADMIN_PANEL
+
+    if text == "📊 Stats":
+        await update.message.reply_text(metrics_summary(), reply_markup=admin_keyboard())
+        return ADMIN_PANEL
+
     if text == "⬅️ Back" or text == "❌ Cancel":
         await update.message.reply_text("Returning to main menu.", reply_markup=main_keyboard(user_id))
         return ConversationHandler.END
@@ -183,6 +1871,7 @@ async def save_initial_welcome(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Cancelled.", reply_markup=admin_keyboard())
         return ADMIN_PANEL
     initial_welcome_text = new_msg
+    state_store.set_setting('initial_welcome_text', new_msg)
     await update.message.reply_text("✅ Initial welcome message updated!", reply_markup=admin_keyboard())
     return ADMIN_PANEL
 
@@ -194,6 +1883,7 @@ async def save_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Cancelled.", reply_markup=admin_keyboard())
         return ADMIN_PANEL
     welcome_text = new_msg
+    state_store.set_setting('welcome_text', new_msg)
     await update.message.reply_text("✅ Main welcome message updated!", reply_markup=admin_keyboard())
     return ADMIN_PANEL
 
@@ -216,6 +1906,8 @@ async def save_welcome_media(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await msg.reply_text("✅ Welcome animation/GIF updated!", reply_markup=admin_keyboard())
     else:
         await msg.reply_text("❌ Please send a photo, document, or GIF.", reply_markup=admin_keyboard())
+        return ADMIN_PANEL
+    state_store.set_setting('welcome_media', list(welcome_media))
     return ADMIN_PANEL
 
 # --- Admin: Add Channel ---
@@ -229,6 +1921,9 @@ async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ADMIN_PANEL
     if entry not in required_channels:
         required_channels.append(entry)
+        channel_chat_ids[entry] = normalize_channel(entry)
+        invalidate_membership(entry)
+        state_store.save_channels()
         await update.message.reply_text(
             f"✅ Channel added!\n\nCurrent channels:\n" + "\n".join(required_channels),
             reply_markup=admin_keyboard()
@@ -247,7 +1942,10 @@ async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Cancelled.", reply_markup=admin_keyboard())
         return ADMIN_PANEL
     if entry in required_channels:
+        invalidate_membership(entry)
         required_channels.remove(entry)
+        channel_chat_ids.pop(entry, None)
+        state_store.save_channels()
         remaining = "\n".join(required_channels) if required_channels else "No channels remaining."
         await update.message.reply_text(
             f"❌ Channel removed!\n\nCurrent channels:\n{remaining}",
@@ -264,26 +1962,11 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("Cancelled.", reply_markup=admin_keyboard())
         return ADMIN_PANEL
     
-    delivered = failed = 0
-    for uid in list(user_ids):
-        try:
-            if msg.photo:
-                await context.bot.send_photo(uid, msg.photo[-1].file_id, caption=msg.caption)
-            elif msg.animation:
-                await context.bot.send_animation(uid, msg.animation.file_id, caption=msg.caption)
-            elif msg.document:
-                await context.bot.send_document(uid, msg.document.file_id, caption=msg.caption)
-            else:
-                await context.bot.send_message(uid, msg.text or "")
-            delivered += 1
-        except Exception as e:
-            logger.error(f"Broadcast failed for user {uid}: {e}")
-            failed += 1
-    
-    await msg.reply_text(
-        f"✅ Broadcast complete!\n\n📤 Delivered: {delivered}\n❌ Failed: {failed}",
-        reply_markup=admin_keyboard()
-    )
+    # Runs in the background; the admin gets one status message that is edited with progress
+    await msg.reply_text("📢 Broadcast queued, progress follows below.", reply_markup=admin_keyboard())
+    status = await msg.reply_text("📢 Broadcast started...")
+    broadcast_id = broadcast_engine.create(msg.chat_id, msg.message_id, status.chat_id, status.message_id)
+    broadcast_engine.start(broadcast_id)
     return ADMIN_PANEL
 
 # --- Send Welcome ---
@@ -330,22 +2013,9 @@ async def send_welcome(update, user_id):
 async def join_channels_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
-    not_joined = []
-    
-    for chan in required_channels:
-        try:
-            cid = chan
-            if cid.startswith("http"):
-                cid = "@" + cid.split("/")[-1]
-            elif not cid.startswith("@"):
-                if not cid.startswith("-"):
-                    cid = "@" + cid.lstrip("@")
-            member = await context.bot.get_chat_member(cid, user_id)
-            if member.status not in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]:
-                not_joined.append(chan)
-        except Exception as e:
-            logger.error(f"Error checking membership for {chan}: {e}")
-            not_joined.append(chan)
+    channels = list(required_channels)
+    results = await asyncio.gather(*(check_membership(context.bot, chan, user_id) for chan in channels))
+    not_joined = [chan for chan, joined in zip(channels, results) if not joined]
     
     if not_joined:
         await query.answer("Please join all required channels first!", show_alert=True)
@@ -361,134 +2031,436 @@ async def join_channels_checker(update: Update, context: ContextTypes.DEFAULT_TY
         await send_welcome(DummyUpdate(query.message), user_id)
 
 # --- Video Link Processing ---
+async def load_video_info(key, url):
+    info = metadata_cache.get(key)
+    if info is None:
+        metrics.inc('savvy_cache_requests_total', cache='metadata', result='miss')
+        with metrics.timer('savvy_extract_seconds', platform=key[0]):
+            info = summarize_info(await run_extract(url, key[0]))
+        metadata_cache.put(key, info)
+    else:
+        metrics.inc('savvy_cache_requests_total', cache='metadata', result='hit')
+    return info
+
 async def process_video_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = update.message.text.strip()
+    global first_link_done
     user_id = update.effective_user.id
     
-    # Quick validation
-    if not ("http" in url.lower() and any(platform in url.lower() for platform in [
-        'youtu', 'instagram', 'tiktok', 'twitter', 'facebook', 'vimeo', 'reddit', 'dailymotion'
-    ])):
+    # Only waits during the first second or so after a restart
+    await extractors_ready.wait()
+    # Rejects anything no extractor accepts before a worker is involved
+    matches = []
+    for token in update.message.text.split():
+        match = url_matcher.match(token) if '.' in token else None
+        if match and match[0] not in (key for key, _ in matches):
+            matches.append(match)
+    if not matches:
         await update.message.reply_text(
             "❌ This doesn't look like a supported video link.\n\nPlease send a valid link from YouTube, Instagram, TikTok, Facebook, Twitter, or other supported platforms.",
             reply_markup=main_keyboard(user_id)
         )
         return
     
+    if len(matches) > 1:
+        processing_msg = await update.message.reply_text(f"🔍 Analyzing {len(matches)} links, please wait...")
+        await process_batch(processing_msg, matches[:BATCH_MAX_ITEMS], None, user_id)
+        return
+    
     processing_msg = await update.message.reply_text("🔍 Analyzing your link, please wait...")
     
+    key, url = matches[0]
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-        }
+        info = await load_video_info(key, url)
+        if 'entries' in info:
+            entries = [match for match in map(url_matcher.match, info['entries']) if match]
+            await process_batch(processing_msg, entries, info['title'], user_id)
+            return
+        formats = info['formats']
         
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            # Filter valid formats - video formats with height
-            formats = [
-                f for f in info.get('formats', [])
-                if f.get('vcodec') != 'none' 
-                and f.get('vcodec') is not None
-                and f.get('height')
-            ]
-            
-            if not formats:
-                await processing_msg.edit_text(
-                    "❌ No downloadable video formats found.\n\nThe video may be:\n• Private or restricted\n• Audio-only\n• Not supported",
-                    reply_markup=main_keyboard(user_id)
-                )
-                return
-            
-            # Extract unique resolutions
-            resolutions = sorted(set(f['height'] for f in formats if f.get('height')), reverse=True)
-            
-            if not resolutions:
-                await processing_msg.edit_text(
-                    "❌ No video resolutions available for this link.",
-                    reply_markup=main_keyboard(user_id)
-                )
-                return
-            
-            # Store data in user context - fix: store format_id mapping properly
-            context.user_data['video_url'] = url
-            context.user_data['video_title'] = info.get('title', 'Video')
-            # Create a mapping of resolution to format_id
-            format_map = {}
-            for f in formats:
-                if f.get('height'):
-                    res_key = f"{f['height']}p"
-                    # Store format_id, preferring formats with both video and audio
-                    if f.get('acodec') and f.get('acodec') != 'none':
-                        format_map[res_key] = f['format_id']
-                    elif res_key not in format_map:
-                        format_map[res_key] = f['format_id']
-            
-            context.user_data['formats'] = format_map
-            
-            # Create quality selection buttons
-            buttons = [[InlineKeyboardButton(f"📥 {res}p", callback_data=f"dl_{res}p")] for res in resolutions[:10]]
-            
-            duration_min = info.get('duration', 0) // 60
-            duration_sec = info.get('duration', 0) % 60
-            
+        # Audio-only sources (podcasts, music hosts) still get the audio button
+        if not formats and not info.get('has_audio_streams'):
             await processing_msg.edit_text(
-                f"🎬 *{info.get('title', 'Video')}*\n\n"
-                f"⏱ Duration: {duration_min} min {duration_sec} sec\n"
-                f"👤 Uploader: {info.get('uploader', 'Unknown')}\n\n"
-                f"Choose your preferred quality:",
-                reply_markup=InlineKeyboardMarkup(buttons),
-                parse_mode=ParseMode.MARKDOWN
+                "❌ No downloadable formats found.\n\nThe video may be:\n• Private or restricted\n• Not supported",
+                reply_markup=main_keyboard(user_id)
             )
-            
+            return
+        
+        # Extract unique resolutions
+        resolutions = sorted(set(f['height'] for f in formats if f.get('height')), reverse=True)
+        
+        # Keep this link's formats server-side; the buttons carry only the session token
+        choices = select_formats(info)
+        choices[AUDIO_QUALITY] = audio_choice(info)
+        token = new_session(session_entry(url, key, info, choices))
+        
+        # Create quality selection buttons, with the expected size where known
+        buttons = []
+        for res in resolutions[:10]:
+            size = choices.get(f"{res}p", (None, None))[1]
+            label = f"📥 {res}p · ~{human_size(size)}" if size else f"📥 {res}p"
+            buttons.append([InlineKeyboardButton(label, callback_data=f"dl_{token}_{res}p")])
+        audio_size = choices.get(AUDIO_QUALITY, (None, None))[1]
+        buttons.append([InlineKeyboardButton(
+            f"🎵 Audio · ~{human_size(audio_size)}" if audio_size else "🎵 Audio",
+            callback_data=f"dl_{token}_{AUDIO_QUALITY}"
+        )])
+        
+        duration_min = int(info['duration']) // 60
+        duration_sec = int(info['duration']) % 60
+        
+        await processing_msg.edit_text(
+            f"🎬 *{info['title']}*\n\n"
+            f"⏱ Duration: {duration_min} min {duration_sec} sec\n"
+            f"👤 Uploader: {info['uploader']}\n\n"
+            f"Choose your preferred quality:",
+            reply_markup=InlineKeyboardMarkup(buttons),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        if not first_link_done:
+            first_link_done = True
+            mark_startup('first_link')
+        
+    except PlatformUnavailable as e:
+        metrics.inc('savvy_failures_total', stage='extract', reason='platform_unavailable')
+        await processing_msg.edit_text(
+            f"🚦 {e.platform} is limiting our requests right now.\n\nPlease try again in {max(1, round(e.retry_in / 60))} min.",
+            reply_markup=main_keyboard(user_id)
+        )
     except Exception as e:
         logger.error(f"Video extraction error: {e}")
+        metrics.inc('savvy_failures_total', stage='extract', reason=failure_reason(e))
         await processing_msg.edit_text(
             "❌ Unable to process this link.\n\n*Possible reasons:*\n• Invalid or unsupported URL\n• Private/restricted video\n• Geo-blocked content\n• Platform temporarily unavailable\n\nPlease try another link.",
             reply_markup=main_keyboard(user_id),
             parse_mode=ParseMode.MARKDOWN
         )
 
+# --- Single-Flight Downloads ---
+# Concurrent requests for the same (video, quality) share one job: the first
+# caller downloads and uploads, later callers await its result and re-send
+# the returned file_id to their own chat. Errors listed in retry_on belong to
+# the caller that hit them (its own download limit, a full queue at that
+# moment); a waiter that sees one runs the job itself instead.
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+
+    def __contains__(self, key):
+        return key in self._inflight
+
+    async def do(self, key, job, retry_on=()):
+        while key in self._inflight:
+            try:
+                return await asyncio.shield(self._inflight[key]), True
+            except retry_on:
+                pass  # the first caller has already let go of the key
+        future = asyncio.get_running_loop().create_future()
+        # Mark the outcome as retrieved even when nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            result = await job()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._inflight[key]
+
+downloads = SingleFlight()
+
+class FileTooLarge(Exception):
+    pass
+
+# --- Download Scheduler ---
+# Caps concurrent downloads globally and per user. Jobs beyond the global cap
+# wait in a bounded priority queue (FIFO within a priority); when it is full
+# new jobs are refused up front instead of slowing everyone down.
+class QueueFull(Exception):
+    pass
+
+class UserLimitReached(Exception):
+    pass
+
+# Refusals that depend on who asked, not on the video
+ADMISSION_ERRORS = (QueueFull, UserLimitReached)
+
+class DownloadScheduler:
+    def __init__(self, max_active, max_per_user, max_queued):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.active = 0
+        self._queue = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._per_user = Counter()
+
+    @property
+    def queued(self):
+        return sum(1 for _, _, future in self._queue if not future.done())
+
+    def _release_user(self, user_id):
+        self._per_user[user_id] -= 1
+        if not self._per_user[user_id]:
+            del self._per_user[user_id]
+
+    def _dispatch(self):
+        while self._queue and self.active < self.max_active:
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():  # cancelled while waiting
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id, priority=1, on_queued=None):
+        if self._per_user[user_id] >= self.max_per_user:
+            raise UserLimitReached()
+        if self.active < self.max_active and not self.queued:
+            self.active += 1
+            self._per_user[user_id] += 1
+        else:
+            if self.queued >= self.max_queued:
+                raise QueueFull()
+            entry = (priority, next(self._seq), asyncio.get_running_loop().create_future())
+            heapq.heappush(self._queue, entry)
+            self._per_user[user_id] += 1
+            try:
+                if on_queued:
+                    position = sum(1 for e in self._queue if e[:2] <= entry[:2] and not e[2].done())
+                    await on_queued(position)
+                await entry[2]
+            except BaseException:
+                self._release_user(user_id)
+                if entry[2].done() and not entry[2].cancelled():
+                    # Got a slot at the same moment we were cancelled; hand it on
+                    self.active -= 1
+                else:
+                    entry[2].cancel()
+                self._dispatch()
+                raise
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._release_user(user_id)
+            self._dispatch()
+
+scheduler = DownloadScheduler(MAX_ACTIVE_DOWNLOADS, MAX_USER_DOWNLOADS, MAX_QUEUED_DOWNLOADS)
+
+# --- Oversize Splitting ---
+# A file over the upload limit is not thrown away: ffmpeg's segment muxer cuts
+# it by stream copy (no re-encode) on keyframes into parts that each fit, and
+# the parts go out together. Cuts are placed by duration, so if a bitrate peak
+# still leaves one part too large the split is redone with one more part.
+FFMPEG = shutil.which('ffmpeg')
+FFPROBE = shutil.which('ffprobe')
+SPLIT_AVAILABLE = bool(FFMPEG and FFPROBE)
+MEDIA_GROUP_MAX = 10  # items per album (sendMediaGroup)
+MAX_DOWNLOAD_SIZE = UPLOAD_LIMIT * SPLIT_MAX_PARTS if SPLIT_AVAILABLE else UPLOAD_LIMIT
+
+async def probe_duration(path):
+    # Seconds, or None when ffprobe cannot tell (live recordings, odd containers)
+    process = await asyncio.create_subprocess_exec(
+        FFPROBE, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    output, _ = await process.communicate()
+    try:
+        duration = float(output)
+    except ValueError:  # empty or "N/A"
+        return None
+    return duration if duration > 0 else None
+
+async def split_media(path, file_size, duration=None):
+    # The part files in order; raises FileTooLarge if SPLIT_MAX_PARTS are not
+    # enough or the duration needed to place the cuts is unknown
+    if not SPLIT_AVAILABLE:
+        raise FileTooLarge(file_size)
+    duration = duration or await probe_duration(path)
+    if not duration:
+        raise FileTooLarge(file_size)
+    stem, ext = os.path.splitext(path)
+    pattern = f"{stem}.part*{ext}"
+    # Aim a little below the limit, since bitrate varies over the video
+    count = math.ceil(file_size / (UPLOAD_LIMIT * 0.9))
+    while count <= SPLIT_MAX_PARTS:
+        for old in glob.glob(pattern):
+            os.remove(old)
+        command = [
+            FFMPEG, '-v', 'error', '-y', '-i', path, '-map', '0:v?', '-map', '0:a?', '-c', 'copy',
+            '-f', 'segment', '-segment_time', f"{duration / count:.3f}", '-reset_timestamps', '1',
+        ]
+        if ext in ('.mp4', '.m4a'):
+            command += ['-segment_format_options', 'movflags=+faststart']
+        process = await asyncio.create_subprocess_exec(
+            *command, f"{stem}.part%02d{ext}",
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, errors = await process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"ffmpeg split failed: {errors.decode(errors='replace')[-300:]}")
+        parts = sorted(glob.glob(pattern))
+        if len(parts) > SPLIT_MAX_PARTS:
+            break  # keyframes too far apart for parts this short
+        if all(os.path.getsize(part) <= UPLOAD_LIMIT for part in parts):
+            return parts
+        count += 1
+    raise FileTooLarge(file_size)
+
 # --- Download and Send Video ---
-async def download_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    quality = query.data.replace("dl_", "")
-    
-    url = context.user_data.get('video_url')
-    title = context.user_data.get('video_title', 'video')
-    format_id = context.user_data.get('formats', {}).get(quality)
-    
-    if not url or not format_id:
-        await query.answer("Session expired. Please resend the link.", show_alert=True)
-        return
-    
-    await query.answer("Download started...")
-    await query.edit_message_text(f"⬇️ Downloading in {quality}...\nPlease wait, this may take a moment.")
+def sent_text(quality):
+    return f"✅ {'Audio' if quality == AUDIO_QUALITY else 'Video'} sent successfully! 🎉"
+
+def video_caption(title, quality, file_size):
+    return f"✅ *{title}*\n\n📊 Quality: {quality}\n📦 Size: {file_size / (1024*1024):.1f} MB"
+
+async def send_result(bot, chat_id, media, quality, title, file_size, user_id, tags=None, **kwargs):
+    # media is a file_id or a file to upload, or a list of them for a split file;
+    # audio goes out as a track (with the duration/title/performer tags, if
+    # given), everything else as a video
+    if isinstance(media, list):
+        return await send_parts(bot, chat_id, media, quality, title, file_size, user_id, tags, **kwargs)
+    kwargs.setdefault('caption', video_caption(title, quality, file_size))
+    kwargs.update(
+        reply_markup=main_keyboard(user_id),
+        parse_mode=ParseMode.MARKDOWN
+    )
+    if quality == AUDIO_QUALITY:
+        return await bot.send_audio(chat_id, media, **(tags or {}), **kwargs)
+    return await bot.send_video(chat_id, media, supports_streaming=True, **kwargs)
+
+async def send_parts(bot, chat_id, parts, quality, title, file_size, user_id, tags=None, **kwargs):
+    # In order: as one album when the parts fit in one, else one message each
+    tags = {name: value for name, value in (tags or {}).items() if name != 'duration'}  # that is the whole track's
+    captions = [
+        f"{video_caption(title, quality, file_size)}\n🧩 Part {n}/{len(parts)}" for n in range(1, len(parts) + 1)
+    ]
+    if len(parts) > MEDIA_GROUP_MAX:
+        return [
+            await send_result(bot, chat_id, part, quality, title, file_size, user_id, tags, caption=caption, **kwargs)
+            for part, caption in zip(parts, captions)
+        ]
+    if quality == AUDIO_QUALITY:
+        album = [
+            InputMediaAudio(part, caption=caption, parse_mode=ParseMode.MARKDOWN, **tags)
+            for part, caption in zip(parts, captions)
+        ]
+    else:
+        album = [
+            InputMediaVideo(part, caption=caption, parse_mode=ParseMode.MARKDOWN, supports_streaming=True)
+            for part, caption in zip(parts, captions)
+        ]
+    return list(await bot.send_media_group(chat_id, album, **kwargs))
+
+def media_file_id(message):
+    media = message.audio or message.video or message.document
+    return media.file_id if media else None
+
+async def send_cached_video(bot, chat_id, key, quality, title, user_id):
+    cached = file_cache.get(key, quality)
+    metrics.inc('savvy_cache_requests_total', cache='file_id', result='miss' if cached is None else 'hit')
+    if cached is None:
+        return False
+    file_id, file_size = cached
+    try:
+        await send_result(bot, chat_id, file_id, quality, title, file_size, user_id)
+    except BadRequest as e:
+        # The file_id is no longer usable; forget it and download again
+        logger.warning(f"Stale cached file_id for {key} {quality}: {e}")
+        file_cache.invalidate(key, quality)
+        return False
+    return True
+
+async def upload_video(bot, chat_id, path, quality, title, file_size, user_id, **kwargs):
+    # path is one file, or the list of parts of a split one
+    paths = path if isinstance(path, list) else [path]
+    kwargs.setdefault('write_timeout', UPLOAD_TIMEOUT)
+    kwargs.setdefault('read_timeout', UPLOAD_TIMEOUT)
+    if LOCAL_BOT_API:
+        # In local mode a Path is sent as a file:// URI: no bytes go over HTTP
+        media = [Path(p) for p in paths]
+        try:
+            return await send_result(
+                bot, chat_id, media if isinstance(path, list) else media[0], quality, title, file_size, user_id, **kwargs
+            )
+        except BadRequest as e:
+            # e.g. the server runs on another host and cannot see our scratch dir
+            logger.warning(f"Local path upload failed, falling back to multipart: {e}")
+    with ExitStack() as stack:
+        media = [stack.enter_context(open(p, 'rb')) for p in paths]
+        return await send_result(
+            bot, chat_id, media if isinstance(path, list) else media[0], quality, title, file_size, user_id, **kwargs
+        )
+
+async def download_and_upload(bot, chat_id, message_id, url, format_spec, size, key, title, quality, user_id, upload_turn=None):
+    # message_id is the status message to edit with progress, or None for none;
+    # upload_turn, if given, is entered around the upload (batch ordering)
+    async def on_queued(position):
+        if message_id:
+            # Runs inside the scheduler: a failed notice must not drop the queued job
+            try:
+                await bot.edit_message_text(
+                    f"⏳ You are #{position} in the queue for {quality}.\nYour download starts automatically.",
+                    chat_id=chat_id, message_id=message_id
+                )
+            except TelegramError as e:
+                logger.warning(f"Could not show queue position to {chat_id}: {e}")
     
-    temp_file = f"/tmp/{uuid4()}.mp4"
+    priority = 0 if user_id == ADMIN_ID else 1
+    if job_queue is not None:
+        file_id, file_size = await download_remote(
+            bot, chat_id, message_id, url, format_spec, size, key, title, quality, user_id, priority
+        )
+    else:
+        # Separate video and audio streams stay on disk next to the merged file
+        # until the merge finishes, so reserve twice the estimate
+        footprint = 2 * (size or UPLOAD_LIMIT)
+        queued_at = time.monotonic()
+        async with scheduler.slot(user_id, priority, on_queued):
+            metrics.observe('savvy_queue_wait_seconds', time.monotonic() - queued_at, platform=key[0], quality=quality)
+            async with scratch.reserve(footprint) as base:
+                file_id, file_size = await download_to_chat(
+                    bot, chat_id, message_id, url, format_spec, base, key, title, quality, user_id, upload_turn
+                )
+    if file_id:
+        file_cache.put(key, quality, file_id, file_size)
+    return file_id, file_size
+
+async def download_to_chat(bot, chat_id, message_id, url, format_spec, base, key, title, quality, user_id, upload_turn=None):
+    if message_id:
+        await bot.edit_message_text(
+            f"⬇️ Downloading in {quality}...\nPlease wait, this may take a moment.", chat_id=chat_id, message_id=message_id
+        )
+    temp_file = f"{base}.mp4"
+    audio = quality == AUDIO_QUALITY
+    progress_path = f"{base}.progress"
     
     try:
-        ydl_opts = {
-            'format': f'{format_id}+bestaudio/best',
-            'outtmpl': temp_file.replace('.mp4', ''),
-            'merge_output_format': 'mp4',
-            'quiet': True,
-            'no_warnings': True,
-            'noplaylist': True,
-        }
-        
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        async with live_status(bot, chat_id, message_id, lambda: download_progress_text(quality, progress_path)):
+            # Estimates can be missing or wrong: never fetch more than can be
+            # delivered, or than the merged file and its streams can take on disk
+            stats = await run_download(
+                url, format_spec, temp_file.replace('.mp4', ''), key[0], audio, progress_path,
+                min(MAX_DOWNLOAD_SIZE, scratch.quota // 2)
+            )
+        if stats.get('too_large'):
+            raise FileTooLarge(stats['bytes'])
+        metrics.observe('savvy_download_seconds', stats['download_seconds'], platform=key[0], quality=quality)
+        metrics.observe('savvy_merge_seconds', stats['merge_seconds'], platform=key[0], quality=quality)
+        metrics.observe('savvy_download_bytes', stats['bytes'], platform=key[0], quality=quality)
         
         # Find the actual downloaded file (yt-dlp may add extension)
         downloaded_file = temp_file.replace('.mp4', '') + '.mp4'
         if not os.path.exists(downloaded_file):
             # Try to find any file with similar name
             pattern = temp_file.replace('.mp4', '') + '*'
-            files = glob.glob(pattern)
+            files = [f for f in glob.glob(pattern) if not f.endswith(('.part', '.progress'))]
             if files:
                 downloaded_file = files[0]
             else:
@@ -496,45 +2468,457 @@ async def download_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         file_size = os.path.getsize(downloaded_file)
         
-        if file_size > MAX_FILESIZE:
-            await query.message.reply_text(
-                "❌ File too large (exceeds 2GB limit).\n\nPlease select a lower quality option.",
-                reply_markup=main_keyboard(user_id)
-            )
-            os.remove(downloaded_file)
-            return
+        if file_size > UPLOAD_LIMIT:
+            # Already paid for the download: send it in parts rather than asking for a lower quality
+            if message_id:
+                await bot.edit_message_text(
+                    f"✂️ {human_size(file_size)} is over the {human_size(UPLOAD_LIMIT)} limit, splitting into parts...",
+                    chat_id=chat_id, message_id=message_id
+                )
+            downloaded_file = await split_media(downloaded_file, file_size, stats['duration'])
         
-        await query.edit_message_text(f"📤 Uploading {quality} video...\nAlmost done!")
+        async with upload_turn or nullcontext():
+            uploading = f"📤 Uploading {'audio' if audio else f'{quality} video'} ({file_size / 1024 ** 2:.1f} MB)..."
+            if isinstance(downloaded_file, list):
+                uploading += f"\n🧩 In {len(downloaded_file)} parts"
+            if message_id:
+                await bot.edit_message_text(f"{uploading}\nAlmost done!", chat_id=chat_id, message_id=message_id)
+            
+            tags = {}
+            if audio:
+                tags = {'duration': int(stats['duration'] or 0), 'title': stats['title'], 'performer': stats['performer']}
+            upload_started = time.monotonic()
+
+            def upload_progress_text():
+                # The Bot API reports no upload progress, so show how long it has been going
+                return f"{uploading}\n⏱ {format_duration(time.monotonic() - upload_started)} elapsed"
+
+            with metrics.timer('savvy_upload_seconds', platform=key[0], quality=quality):
+                async with live_status(bot, chat_id, message_id, upload_progress_text):
+                    sent = await upload_video(bot, chat_id, downloaded_file, quality, title, file_size, user_id, tags=tags)
         
-        with open(downloaded_file, 'rb') as video_file:
-            await query.message.reply_video(
-                video_file,
-                caption=f"✅ *{title}*\n\n📊 Quality: {quality}\n📦 Size: {file_size / (1024*1024):.1f} MB",
-                reply_markup=main_keyboard(user_id),
-                parse_mode=ParseMode.MARKDOWN,
-                supports_streaming=True
+        if isinstance(sent, list):
+            file_ids = [media_file_id(message) for message in sent]
+            return (file_ids if all(file_ids) else None), file_size
+        return media_file_id(sent), file_size
+    
+    finally:
+        # Clean up the download and any partial files
+        pattern = temp_file.replace('.mp4', '') + '*'
+        for file in glob.glob(pattern):
+            try:
+                if os.path.exists(file):
+                    os.remove(file)
+            except Exception:
+                pass
+
+# --- Remote Downloads ---
+# The frontend still bounds outstanding jobs and applies the per-user cap, but
+# nothing is downloaded here: the job is handed to the queue and polled until
+# a worker reports the file_id it uploaded.
+remote_slots = DownloadScheduler(JOB_MAX_OUTSTANDING, MAX_USER_DOWNLOADS, 0)
+
+async def download_remote(bot, chat_id, message_id, url, format_spec, size, key, title, quality, user_id, priority):
+    async with remote_slots.slot(user_id):
+        job_id = await job_queue.enqueue({
+            'url': url, 'format_spec': format_spec, 'size': size, 'key': list(key), 'title': title,
+            'quality': quality, 'user_id': user_id, 'chat_id': chat_id, 'message_id': message_id,
+        }, priority)
+        queued_at = time.monotonic()
+        last_position = None
+        try:
+            while True:
+                status, result = await job_queue.get(job_id)
+                if status != 'queued' and queued_at is not None:
+                    metrics.observe('savvy_queue_wait_seconds', time.monotonic() - queued_at, platform=key[0], quality=quality)
+                    queued_at = None
+                if status == 'done':
+                    return result['file_id'], result['file_size']
+                if status == 'failed':
+                    if result.get('error') == 'too_large':
+                        raise FileTooLarge(result.get('message'))
+                    raise RuntimeError(result.get('message') or 'worker failed')
+                if status == 'queued':
+                    position = await job_queue.position(job_id)
+                    if message_id and position and position != last_position:
+                        last_position = position
+                        await progress_editor.edit(
+                            bot, chat_id, message_id,
+                            f"⏳ You are #{position} in the queue for {quality}.\nYour download starts automatically."
+                        )
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+        except BaseException:
+            # Shutdown or a queue error: nobody is waiting for this job any more, so
+            # withdraw it unless a worker already has it (a no-op for finished jobs)
+            try:
+                await job_queue.cancel(job_id)
+            except Exception as e:
+                logger.warning(f"Could not cancel job {job_id}: {e}")
+            raise
+
+# --- Download Worker ---
+# `python bot.py worker` runs no handlers: it claims jobs from JOB_QUEUE_URL,
+# downloads into its own scratch dir and uploads to the user's chat with the
+# same bot token. Scale by starting more workers.
+async def process_job(bot, job_id, job):
+    key = tuple(job['key'])
+    footprint = 2 * (job['size'] or UPLOAD_LIMIT)
+
+    async def beat():
+        while True:
+            await asyncio.sleep(JOB_STALE_AFTER / 4)
+            await job_queue.heartbeat(job_id)
+
+    heartbeat = asyncio.create_task(beat())
+    try:
+        async with scratch.reserve(footprint) as base:
+            file_id, file_size = await download_to_chat(
+                bot, job['chat_id'], job['message_id'], job['url'], job['format_spec'],
+                base, key, job['title'], job['quality'], job['user_id']
             )
+        await job_queue.finish(job_id, 'done', {'file_id': file_id, 'file_size': file_size})
+    except asyncio.CancelledError:
+        # Shutting down: let another worker pick the job up
+        await job_queue.requeue(job_id)
+        raise
+    except (FileTooLarge, ScratchFull) as e:
+        await job_queue.finish(job_id, 'failed', {'error': 'too_large', 'message': str(e)})
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        metrics.inc('savvy_failures_total', stage='download', reason=failure_reason(e))
+        await job_queue.finish(job_id, 'failed', {'error': failure_reason(e), 'message': str(e)})
+    finally:
+        heartbeat.cancel()
+
+async def worker_loop(bot, worker_id):
+    while True:
+        claimed = await job_queue.claim(worker_id)
+        if claimed is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        await process_job(bot, *claimed)
+
+async def run_worker():
+    global job_queue
+    job_queue = open_job_queue(JOB_QUEUE_URL)
+    worker_id = f"{os.uname().nodename}:{os.getpid()}"
+    # Other workers on this host may be mid-download in the same SCRATCH_DIR
+    scratch.isolate(f"worker-{worker_id.replace(':', '-')}")
+    warmup = asyncio.create_task(warm_up_downloads())
+    if METRICS_PORT:
+        await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+    bot_kwargs = {}
+    if BOT_API_URL:
+        bot_kwargs = {'base_url': BOT_API_URL, 'local_mode': LOCAL_BOT_API}
+        if BOT_API_FILE_URL:
+            bot_kwargs['base_file_url'] = BOT_API_FILE_URL
+    bot = Bot(BOT_TOKEN, **bot_kwargs)
+    async with bot:
+        loops = [asyncio.create_task(worker_loop(bot, f"{worker_id}:{n}")) for n in range(WORKER_CONCURRENCY)]
+        logger.info(f"Worker {worker_id} running {WORKER_CONCURRENCY} download slots")
+        try:
+            while True:
+                await asyncio.sleep(JOB_STALE_AFTER / 2)
+                requeued = await job_queue.recover_stale(JOB_STALE_AFTER, JOB_MAX_ATTEMPTS)
+                if requeued:
+                    logger.warning(f"Requeued {requeued} jobs from unresponsive workers")
+        finally:
+            warmup.cancel()
+            for loop in loops:
+                loop.cancel()
+            await asyncio.gather(*loops, return_exceptions=True)
+            shutdown_pools()
+
+async def download_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    session, quality = parse_download_data(query.data)
+    if session is None:
+        await query.answer("Session expired. Please resend the link.", show_alert=True)
+        return
+    
+    url = session['url']
+    key = session['key']
+    title = session['title']
+    format_spec = session['formats'].get(quality)
+    size = session['sizes'].get(quality)
+    
+    if not format_spec:
+        await query.answer("Session expired. Please resend the link.", show_alert=True)
+        return
+    
+    if await send_cached_video(query.get_bot(), query.message.chat_id, key, quality, title, user_id):
+        await query.answer("✅ Sent!")
+        await query.message.reply_text(sent_text(quality), reply_markup=main_keyboard(user_id))
+        return
+    
+    if size and size > MAX_DOWNLOAD_SIZE:
+        metrics.inc('savvy_failures_total', stage='admission', reason='too_large')
+        # Refuse before fetching anything instead of after downloading gigabytes
+        await query.answer(
+            f"❌ {quality} is about {human_size(size)}, over the {human_size(MAX_DOWNLOAD_SIZE)} limit. Please choose a lower quality.",
+            show_alert=True
+        )
+        return
+    
+    await query.answer("Download started...")
+    if (key, quality) in downloads:
+        await query.edit_message_text(f"⬇️ Downloading in {quality}...\nPlease wait, this may take a moment.")
+    
+    try:
+        (file_id, file_size), shared = await downloads.do(
+            (key, quality),
+            lambda: download_and_upload(
+                query.get_bot(), query.message.chat_id, query.message.message_id,
+                url, format_spec, size, key, title, quality, user_id
+            ),
+            retry_on=ADMISSION_ERRORS
+        )
         
-        await query.message.reply_text("✅ Video sent successfully! 🎉", reply_markup=main_keyboard(user_id))
+        if shared:
+            if not file_id:
+                raise RuntimeError("Shared download produced no file_id")
+            await send_result(query.get_bot(), query.message.chat_id, file_id, quality, title, file_size, user_id)
         
-        os.remove(downloaded_file)
+        await query.message.reply_text(sent_text(quality), reply_markup=main_keyboard(user_id))
         
+    except UserLimitReached:
+        metrics.inc('savvy_failures_total', stage='download', reason='user_limit')
+        await query.message.reply_text(
+            f"⏳ You already have {MAX_USER_DOWNLOADS} downloads in progress.\n\nPlease wait for them to finish.",
+            reply_markup=main_keyboard(user_id)
+        )
+    except QueueFull:
+        metrics.inc('savvy_failures_total', stage='download', reason='queue_full')
+        await query.message.reply_text(
+            "🚦 The bot is very busy right now.\n\nPlease try again in a few minutes.",
+            reply_markup=main_keyboard(user_id)
+        )
+    except (FileTooLarge, ScratchFull):
+        metrics.inc('savvy_failures_total', stage='download', reason='too_large')
+        await query.message.reply_text(
+            f"❌ File too large (exceeds {MAX_DOWNLOAD_SIZE // (1024*1024)} MB limit).\n\nPlease select a lower quality option.",
+            reply_markup=main_keyboard(user_id)
+        )
     except Exception as e:
         logger.error(f"Download error: {e}")
+        metrics.inc('savvy_failures_total', stage='download', reason=failure_reason(e))
         await query.message.reply_text(
             "❌ Download failed.\n\n*Possible reasons:*\n• Network connection issues\n• File too large\n• Video restricted or deleted\n• Platform rate limiting\n\nPlease try again or select a different quality.",
             reply_markup=main_keyboard(user_id),
             parse_mode=ParseMode.MARKDOWN
         )
-        
-        # Clean up any partial files
-        pattern = temp_file.replace('.mp4', '') + '*'
-        for file in glob.glob(pattern):
+
+# --- Batch Downloads ---
+# Several links in one message, or a playlist link, become one batch: the
+# entries are extracted concurrently, the user picks one quality for all of
+# them, and the videos are delivered in the original order. Downloads run up
+# to the user's concurrency cap; InOrder holds each upload until every
+# earlier entry has been delivered (or has failed).
+class InOrder:
+    def __init__(self):
+        self._next = 0
+        self._changed = asyncio.Condition()
+
+    async def wait(self, index):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._next >= index)
+
+    async def done(self, index):
+        async with self._changed:
+            if self._next == index:
+                self._next += 1
+                self._changed.notify_all()
+
+    @asynccontextmanager
+    async def turn(self, index):
+        await self.wait(index)
+        try:
+            yield
+        finally:
+            await self.done(index)
+
+def pick_quality(formats, quality):
+    # Audio as is; for video the highest quality not above the choice, else the
+    # lowest available, and audio for an audio-only source
+    heights = sorted((int(res[:-1]) for res in formats if res != AUDIO_QUALITY), reverse=True)
+    if quality == AUDIO_QUALITY or not heights:
+        return AUDIO_QUALITY
+    target = int(quality[:-1])
+    below = [h for h in heights if h <= target]
+    return f"{below[0] if below else heights[-1]}p"
+
+async def process_batch(processing_msg, matches, title, user_id):
+    limit = asyncio.Semaphore(BATCH_EXTRACT_CONCURRENCY)
+    done = 0
+
+    async def analyze(key, url):
+        nonlocal done
+        async with limit:
             try:
-                if os.path.exists(file):
-                    os.remove(file)
-            except Exception:
+                info = await load_video_info(key, url)
+            except Exception as e:
+                logger.warning(f"Batch entry {url} failed: {e}")
+                metrics.inc('savvy_failures_total', stage='extract', reason=failure_reason(e))
+                info = None
+        done += 1
+        if done % 5 == 0 and done < len(matches):
+            try:
+                await processing_msg.edit_text(f"🔍 Analyzed {done}/{len(matches)} links...")
+            except BadRequest:
                 pass
+        if not info or 'entries' in info:
+            return None  # unavailable, or a playlist inside the batch
+        choices = select_formats(info)
+        if not choices and not info.get('has_audio_streams'):
+            return None
+        choices[AUDIO_QUALITY] = audio_choice(info)
+        return session_entry(url, key, info, choices)
+
+    entries = [e for e in await asyncio.gather(*(analyze(key, url) for key, url in matches)) if e]
+    if not entries:
+        await processing_msg.edit_text(
+            "❌ None of these links has a downloadable video.",
+            reply_markup=main_keyboard(user_id)
+        )
+        return
+    
+    token = new_session({'title': title, 'batch': entries})
+    heights = sorted(
+        {int(res[:-1]) for entry in entries for res in entry['formats'] if res != AUDIO_QUALITY}, reverse=True
+    )
+    buttons = []
+    for quality in [f"{height}p" for height in heights[:10]] + [AUDIO_QUALITY]:
+        sizes = [entry['sizes'].get(pick_quality(entry['formats'], quality)) for entry in entries]
+        name = "🎵 Audio" if quality == AUDIO_QUALITY else f"📥 {quality}"
+        label = f"{name} · ~{human_size(sum(sizes))}" if all(sizes) else name
+        buttons.append([InlineKeyboardButton(label, callback_data=f"dlb_{token}_{quality}")])
+    
+    listing = "\n".join(f"{i}. {entry['title'][:60]}" for i, entry in enumerate(entries, 1))
+    skipped = len(matches) - len(entries)
+    await processing_msg.edit_text(
+        f"📦 *{title or 'Batch'}*\n\n{listing}\n\n"
+        + (f"⚠️ {skipped} link(s) could not be processed.\n\n" if skipped else "")
+        + "Choose one quality for all videos (lower is used where it is not available), or audio only:",
+        reply_markup=InlineKeyboardMarkup(buttons),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def batch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    session, quality = parse_download_data(query.data)
+    if session is None or 'batch' not in session:
+        await query.answer("Session expired. Please resend the links.", show_alert=True)
+        return
+    
+    entries = session['batch']
+    bot, chat_id = query.get_bot(), query.message.chat_id
+    await query.answer("Batch started...")
+    target = "as audio" if quality == AUDIO_QUALITY else f"in up to {quality}"
+    await query.edit_message_text(f"⬇️ Downloading {len(entries)} videos {target}...\nThey arrive in order.")
+    
+    order = InOrder()
+    # Remote workers upload on their own schedule, so keep order by going one at a time
+    running = asyncio.Semaphore(1 if job_queue is not None else MAX_USER_DOWNLOADS)
+
+    async def report(index, entry, text):
+        async with order.turn(index):
+            try:
+                await bot.send_message(chat_id, f"{text} {index + 1}. {entry['title'][:60]}")
+            except TelegramError as e:
+                logger.warning(f"Could not report batch entry {index + 1}: {e}")
+
+    async def deliver(index, entry):
+        # One entry failing (a send error included) must not stop the rest of the batch
+        try:
+            return await attempt(index, entry)
+        except Exception as e:
+            logger.error(f"Batch delivery error: {e}")
+            metrics.inc('savvy_failures_total', stage='download', reason=failure_reason(e))
+            await report(index, entry, "❌ Failed:")
+            return False
+
+    async def attempt(index, entry):
+        res = pick_quality(entry['formats'], quality)
+        key, title, size = entry['key'], entry['title'], entry['sizes'].get(res)
+        async with running:
+            if size and size > MAX_DOWNLOAD_SIZE:
+                metrics.inc('savvy_failures_total', stage='admission', reason='too_large')
+                await report(index, entry, f"❌ Over the {human_size(MAX_DOWNLOAD_SIZE)} limit in {res}:")
+                return False
+            if file_cache.has(key, res):
+                await order.wait(index)
+                if await send_cached_video(bot, chat_id, key, res, title, user_id):
+                    await order.done(index)
+                    return True
+            while True:
+                try:
+                    (file_id, file_size), shared = await downloads.do(
+                        (key, res),
+                        lambda: download_and_upload(
+                            bot, chat_id, None, entry['url'], entry['formats'][res], size, key, title, res, user_id,
+                            upload_turn=order.turn(index)
+                        ),
+                        retry_on=ADMISSION_ERRORS
+                    )
+                    break
+                except UserLimitReached:
+                    # The user's own single downloads hold the slots; wait for them
+                    await asyncio.sleep(2)
+                except Exception as e:
+                    logger.error(f"Batch download error: {e}")
+                    metrics.inc('savvy_failures_total', stage='download', reason=failure_reason(e))
+                    await report(index, entry, "❌ Failed:")
+                    return False
+            if shared:
+                if not file_id:
+                    logger.error(f"Shared batch download of {key} {res} produced no file_id")
+                    metrics.inc('savvy_failures_total', stage='download', reason='no_file_id')
+                    await report(index, entry, "❌ Failed:")
+                    return False
+                async with order.turn(index):
+                    await send_result(bot, chat_id, file_id, res, title, file_size, user_id)
+            return True
+
+    results = await asyncio.gather(*(deliver(i, entry) for i, entry in enumerate(entries)))
+    await bot.send_message(
+        chat_id,
+        f"✅ Batch finished: {sum(results)}/{len(entries)} videos sent! 🎉",
+        reply_markup=main_keyboard(user_id)
+    )
+
+# --- Lifecycle ---
+metrics_server = None
+
+async def on_startup(application: Application):
+    global state_store, file_cache, broadcast_engine, metrics_server, job_queue, warmup_task
+    # A frontend that hands downloads to workers never needs the download pool
+    warmup_task = asyncio.create_task(warm_up(downloads=not JOB_QUEUE_URL))
+    if JOB_QUEUE_URL:
+        job_queue = open_job_queue(JOB_QUEUE_URL)
+    else:
+        scratch.sweep()
+    if METRICS_PORT:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    state_store = StateStore(get_db())
+    state_store.load()
+    state_store.start()
+    file_cache = FileIdCache(get_db())
+    broadcast_engine = BroadcastEngine(application.bot, get_db())
+    broadcast_engine.resume_all()
+    mark_startup('telegram')
+
+async def on_shutdown(application: Application):
+    if metrics_server is not None:
+        metrics_server.close()
+    if warmup_task is not None:
+        warmup_task.cancel()
+    broadcast_engine.stop_all()
+    state_store.stop()
+    shutdown_pools()
+    close_db()
 
 # --- Main Function ---
 def main():
@@ -544,7 +2928,25 @@ def main():
         print("💡 Set it as: export BOT_TOKEN='your_token_here'")
         return
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        logger.error("BOT_MODE=webhook requires WEBHOOK_URL")
+        print("❌ ERROR: WEBHOOK_URL not set!")
+        print("💡 Set it as: export WEBHOOK_URL='https://your.domain'")
+        return
+    
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_API_URL:
+        # The bot must have been logged out of the public API once before switching
+        builder = builder.base_url(BOT_API_URL).local_mode(LOCAL_BOT_API)
+        if BOT_API_FILE_URL:
+            builder = builder.base_file_url(BOT_API_FILE_URL)
+    application = builder.build()
     
     # Admin conversation handler
     admin_conv = ConversationHandler(
@@ -574,11 +2976,40 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
     application.add_handler(CallbackQueryHandler(join_channels_checker, pattern="check_joined"))
     application.add_handler(CallbackQueryHandler(download_callback, pattern="^dl_"))
+    application.add_handler(CallbackQueryHandler(batch_callback, pattern="^dlb_"))
+    
+    # Only the update types the handlers above consume; Telegram skips the rest
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
     
     logger.info("Bot started successfully!")
     print("✅ Bot is running...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        secret = WEBHOOK_SECRET
+        if not secret:
+            # Random per start: Telegram gets the new one with setWebhook, so only it can post updates
+            secret = secrets.token_urlsafe(32)
+            logger.warning("WEBHOOK_SECRET not set, using a random secret token for this run")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates
+        )
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ['worker']:
+        if not JOB_QUEUE_URL:
+            print("❌ ERROR: JOB_QUEUE_URL not set!")
+        else:
+            try:
+                asyncio.run(run_worker())
+            except KeyboardInterrupt:
+                pass
+    else:
+        main()
 